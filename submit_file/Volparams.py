@@ -9,7 +9,10 @@ class volparams(object):
 
     def __init__(self, fnames=None, fr=None, index=None, ROIs=None, weights=None, doCrossVal=False, doGlobalSubtract=False,
             contextSize=50, censorSize=12, nPC_bg=8, tau_lp=3, tau_pred=1, sigmas=np.array([1,1.5,2]),
-            nIter=5, localAlign=False, globalAlign=False, highPassRegression=False, params_dict={}):
+            nIter=5, localAlign=False, globalAlign=False, highPassRegression=False, nIterWarm=2,
+            globalBackground=False, sharedCrops=False, fnames_tiled=None, groupOverlap=0, memoryBudget=None, hpBackend='iir',
+            hpThreads=1, fnames_hp=None, fftWisdom=None, jaccardTol=0, weightTol=0, diagnostics=False,
+            resultsFolder=None, outputFields=None, params_dict={}):
         """Class for setting parameters for voltage imaging. Including parameters for the data, motion correction and
         spike detection. The prefered way to set parameters is by using the set function, where a subclass is determined
         and a dictionary is passed. The whole dictionary can also be initialized at once by passing a dictionary
@@ -17,10 +20,13 @@ class volparams(object):
         """
         self.data = {
             'fnames': fnames, # name of the movie, only memory map file for spike detection
+            'fnames_tiled': fnames_tiled, # tiled copy of the movie written by movieIO.saveTiled for reading context windows
+            'fnames_hp': fnames_hp, # high-passed, mean-subtracted movie written by globalModels.saveHighpassed, read instead of filtering every context window
             'fr': fr, # sample rate of the movie
             'index': index, # a list of cell numbers for processing
             'ROIs': ROIs, # a 3-d matrix contains all region of interests
-            'weights': weights  # spatial weights generated by previous blocks as initialization  
+            'weights': weights,  # spatial filters generated by previous blocks as initialization, e.g. vpy.estimates['spatialFilter']
+            'resultsFolder': resultsFolder  # folder where the output of every cell is written as it finishes, None to keep them in memory; a fit with the same folder only runs the missing or changed cells, each movie has its own subfolder
         }
 
         self.volspike = {
@@ -34,9 +40,21 @@ class volparams(object):
             'tau_pred': tau_pred, # time window in seconds for high pass filtering to make predictor for regression
             'sigmas': sigmas, # spatial smoothing radius imposed on spatial filter;
             'nIter': nIter, # number of iterations alternating between estimating temporal and spatial filters
+            'nIterWarm': nIterWarm, # number of iterations when starting from the weights of a previous block
+            'jaccardTol': jaccardTol, # stop iterating when the Jaccard distance between consecutive spike sets is at most this, None never stops early
+            'weightTol': weightTol, # and the relative change of the spatial weights is at most this, None never stops early
             'localAlign': localAlign,
             'globalAlign': globalAlign,
-            'highPassRegression': highPassRegression # regress on a high-passed version of the data. Slightly improves detection of spikes, but makes subthreshold unreliable
+            'outputFields': outputFields, # outputs of volspike kept in the estimates, None for the default ones of VOLPY.fit; the others are not sent back by the workers
+            'diagnostics': diagnostics, # store the arrays of the diagnostic figures in the estimates instead of plotting, see report.renderReport
+            'highPassRegression': highPassRegression, # regress on a high-passed version of the data. Slightly improves detection of spikes, but makes subthreshold unreliable
+            'globalBackground': globalBackground, # compute background components once per movie with all ROIs masked out, instead of once per cell
+            'sharedCrops': sharedCrops, # extract the context windows of all cells in one pass over the movie into shared memory
+            'groupOverlap': groupOverlap, # process cells together when their context windows overlap by at least this fraction (intersection over union), 0 disables grouping
+            'hpBackend': hpBackend, # 'iir' filters forward and backward, 'fft' applies the same zero-phase response in the frequency domain, faster for long recordings
+            'hpThreads': hpThreads, # threads of the high-pass filters in every worker, keep the product with the number of workers under the number of cores
+            'fftWisdom': fftWisdom, # file of FFTW wisdom saved by VOLPY.fit and loaded by every worker, None to plan in every process
+            'memoryBudget': memoryBudget # bytes of memory the cells running at the same time may use, by default 80% of the available memory
         }
 
         self.motion = {
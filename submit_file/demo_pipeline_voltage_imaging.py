@@ -31,6 +31,10 @@ except NameError:
 import caiman as cm
 from caiman.motion_correction import MotionCorrect
 from caiman.utils.utils import download_demo
+from caiman.source_extraction.volpy.globalModels import saveHighpassed
+from caiman.source_extraction.volpy.movieIO import saveTiled
+from caiman.source_extraction.volpy.processPool import VolpyPool
+from caiman.source_extraction.volpy.report import renderReport
 from caiman.source_extraction.volpy.Volparams import volparams
 from caiman.source_extraction.volpy.volpy import VOLPY
 import matplotlib.pyplot as plt
@@ -66,8 +70,8 @@ def main():
     # dataset parameters
     fr = 400                                        # sample rate of the movie
     index = list(range(ROIs.shape[0]))              # index of neurons
-    weights = None                                  # reuse spatial weights by 
-                                                    # opts.change_params(params_dict={'weights':vpy.estimates['weights']})
+    weights = None                                  # reuse spatial filters by 
+                                                    # opts.change_params(params_dict={'weights':vpy.estimates['spatialFilter']})
     # motion correction parameters
     motion_correct = True                           # flag for motion correction
     pw_rigid = True                                 # flag for pw-rigid motion correction
@@ -139,10 +143,29 @@ def main():
     fname_new = mc_pw.mmap_file[0]  # memory map file name
     opts.change_params(params_dict={'fnames':fname_new})
 
+    # %% store the movie in tiles for faster reading of the context windows (optional)
+    tiled = False
+    if tiled:
+        fname_tiled = saveTiled(fname_new)
+        opts.change_params(params_dict={'fnames_tiled':fname_tiled})
+
+    # %% high-pass the movie once for all cells instead of once per context window (optional)
+    highpassed = False
+    if highpassed:
+        fname_hp = saveHighpassed(fname_new, opts.data['fr'], opts.volspike['tau_lp'],
+                                  fnames_tiled=fname_tiled if tiled else None)
+        opts.change_params(params_dict={'fnames_hp':fname_hp})
+
     # %% restart cluster to clean up memory
     cm.stop_server(dview=dview)
-    c, dview, n_processes = cm.cluster.setup_cluster(
-        backend='local', n_processes=12, single_thread=False)
+    nativePool = False
+    if nativePool:
+        # persistent workers replaced when they grow beyond maxMemory, instead of a caiman cluster
+        dview = VolpyPool(n_processes=12, blasThreads=1, maxMemory=8 * 2 ** 30)
+        n_processes = dview.n_processes
+    else:
+        c, dview, n_processes = cm.cluster.setup_cluster(
+            backend='local', n_processes=12, single_thread=False)
 
     # %% process cells using volspike function
     vpy = VOLPY(n_processes=n_processes, dview=dview, params=opts)
@@ -165,8 +188,19 @@ def main():
     plt.title('spatial filter')
     plt.show()
 
+    # %% diagnostic figures of all cells, if fitted with diagnostics=True
+    if 'diagnostics' in vpy.estimates:
+        renderReport(vpy.estimates['diagnostics'], os.path.join(os.path.dirname(fname_new), 'volpy_report'),
+                     dview=dview)
+
+    # %% save the estimates, reload them with VolpyEstimates.load
+    vpy.estimates.save(os.path.join(os.path.dirname(fname_new), 'volpy_estimates.npz'))
+
     # %% STOP CLUSTER and clean up log files
-    cm.stop_server(dview=dview)
+    if nativePool:
+        dview.close()
+    else:
+        cm.stop_server(dview=dview)
     log_files = glob.glob('*_LOG_*')
     for log_file in log_files:
         os.remove(log_file)
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk store of the outputs of volspike, written cell by cell as the workers finish
+so that the results of a session never need to be held in memory at once. Each cell
+is stored with a key of its inputs, so that an interrupted run can be resumed by
+running again only the cells which are missing or whose inputs changed.
+
+The estimates of a fit are held column by column in VolpyEstimates: the traces as a
+dense cells x frames float32 matrix, and the spike times and other arrays of varying
+length as flat arrays with offsets, CSR style.
+"""
+import hashlib
+import json
+import numpy as np
+import os
+import pickle
+from numpy.lib.format import open_memmap
+
+
+class EstimatesStore(object):
+    """ Folder with one file per cell holding the output dictionary of volspike, and a
+        record of the cells which failed.
+    """
+    def __init__(self, folder):
+        """
+            folder: str
+                folder of the store, created if needed
+        """
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.failures = {}
+        if os.path.exists(self._failuresName()):
+            with open(self._failuresName()) as f:
+                self.failures = {int(k): v for k, v in json.load(f).items()}
+
+    def _cellName(self, cellN):
+        return os.path.join(self.folder, 'cell_{0}.pkl'.format(cellN))
+
+    def _keyName(self, cellN):
+        return os.path.join(self.folder, 'cell_{0}.key'.format(cellN))
+
+    def _failuresName(self):
+        return os.path.join(self.folder, 'failures.json')
+
+    def add(self, output, key=None):
+        """ Write the output of a cell with write and clear a failure recorded for it
+        """
+        self.write(output, key)
+        self.clearFailure(output['cellN'])
+
+    def write(self, output, key=None):
+        """ Write the output of a cell; the file is replaced atomically and the key is
+            written last, so that a cell interrupted while being written is never current.
+            Unlike add, the record of failures is left alone, so that the workers can write
+            their cells to the store while the failures are kept by the main process
+
+        Args:
+            output: dict
+                output of volspike for one cell
+
+            key: str
+                key of the inputs of the cell given by checkpointKey
+        """
+        fname = self._cellName(output['cellN'])
+        kname = self._keyName(output['cellN'])
+        if os.path.exists(kname):
+            os.remove(kname)
+        with open(fname + '.tmp', 'wb') as f:
+            pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fname + '.tmp', fname)
+        if key is not None:
+            with open(kname + '.tmp', 'w') as f:
+                f.write(key)
+            os.replace(kname + '.tmp', kname)
+
+    def clearFailure(self, cellN):
+        """ Forget a failure recorded for the cell
+        """
+        if cellN in self.failures:
+            del self.failures[cellN]
+            self._saveFailures()
+
+    def addFailure(self, cellNs, error):
+        """ Record that the cells failed with the given error
+        """
+        for cellN in cellNs:
+            self.failures[int(cellN)] = repr(error)
+        self._saveFailures()
+
+    def _saveFailures(self):
+        with open(self._failuresName(), 'w') as f:
+            json.dump({str(k): v for k, v in self.failures.items()}, f, indent=1)
+
+    def __contains__(self, cellN):
+        return os.path.exists(self._cellName(cellN))
+
+    def isCurrent(self, cellN, key):
+        """ Whether the cell is stored with the given key, i.e. computed from the same inputs
+        """
+        if cellN not in self or not os.path.exists(self._keyName(cellN)):
+            return False
+        with open(self._keyName(cellN)) as f:
+            return f.read() == key
+
+    def load(self, cellN):
+        """ Output dictionary of a cell
+        """
+        with open(self._cellName(cellN), 'rb') as f:
+            return pickle.load(f)
+
+
+def _digest(h, value):
+    """ Feed a parameter value, possibly a nested dict, list or array, to the hash h
+    """
+    if isinstance(value, dict):
+        h.update(b'{')
+        for k in sorted(value, key=str):
+            _digest(h, k)
+            _digest(h, value[k])
+        h.update(b'}')
+    elif isinstance(value, (list, tuple)):
+        h.update(b'[')
+        for v in value:
+            _digest(h, v)
+        h.update(b']')
+    elif isinstance(value, np.ndarray):
+        h.update('{0}{1}'.format(value.dtype.str, value.shape).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, np.generic):
+        _digest(h, value.item())
+    else:
+        h.update(repr(value).encode())
+
+
+def movieKey(fname):
+    """ Identity of a movie file: its name, size and modification time
+    """
+    stat = os.stat(fname)
+    return [os.path.basename(fname), stat.st_size, stat.st_mtime_ns]
+
+
+def movieFolder(folder, fname):
+    """ Subfolder of a results folder holding the store of one movie, so that the data
+        blocks of a recording can share a results folder without overwriting each other
+    """
+    return os.path.join(folder, os.path.splitext(os.path.basename(fname))[0])
+
+
+def checkpointKey(movie, cellN, ROI, weights, params):
+    """ Key of the inputs of a cell; a stored cell whose key differs is computed again
+
+    Args:
+        movie: list
+            identity of the movie given by movieKey
+
+        cellN: int
+            cell number
+
+        ROI: 2-d array
+            region of interest of the cell
+
+        weights: 1-d array or None
+            spatial weights used as initialization
+
+        params: dict
+            parameters of volspike which change its output
+
+    Returns:
+        key: str
+            hexadecimal digest
+    """
+    h = hashlib.sha1()
+    _digest(h, [movie, int(cellN), ROI, weights, params])
+    return h.hexdigest()
+
+
+class Ragged(object):
+    """ Arrays of varying shapes, one per cell, stored CSR style as one flat array with
+        the offsets of the arrays in it and their shapes
+    """
+    def __init__(self, data, offsets, shapes):
+        """
+            data: 1-d array
+                concatenation of the flattened arrays
+
+            offsets: 1-d array
+                start of every array in data, followed by the length of data
+
+            shapes: 2-d array
+                shape of every array, one row per array
+        """
+        self.data = data
+        self.offsets = offsets
+        self.shapes = shapes
+
+    @classmethod
+    def fromList(cls, arrays, dtype=None):
+        """ Ragged from a list of arrays with the same number of dimensions, converted to
+            dtype if given
+        """
+        arrays = [np.asarray(a, dtype=dtype) for a in arrays]
+        ndim = arrays[0].ndim if arrays else 1
+        shapes = np.array([a.shape for a in arrays], dtype=np.int64).reshape(-1, ndim)
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([a.size for a in arrays])
+        if arrays:
+            data = np.concatenate([a.ravel() for a in arrays])
+        else:
+            data = np.zeros(0, dtype=dtype)
+        return cls(data, offsets, shapes)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[k] for k in range(*n.indices(len(self)))]
+        if not np.isscalar(n):
+            return [self[k] for k in n]
+        if n < 0:
+            n += len(self)
+        return self.data[self.offsets[n]:self.offsets[n + 1]].reshape(self.shapes[n])
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
+
+    def tolist(self):
+        return list(self)
+
+
+def _toColumn(values, dtype=None):
+    """ Column of VolpyEstimates from a list with one value per cell: a dense array if all
+        values have the same shape, Ragged if they are arrays of varying shapes, and the
+        list itself for other objects such as dictionaries or None
+    """
+    if isinstance(values, np.ndarray):
+        # arrays of the right type, e.g. a memory mapped trace matrix, are kept as they are
+        if dtype is not None and values.dtype != dtype:
+            return values.astype(dtype)
+        return values
+    if isinstance(values, Ragged):
+        if dtype is not None and values.data.dtype != dtype:
+            return Ragged(values.data.astype(dtype), values.offsets, values.shapes)
+        return values
+    values = list(values)
+    if any(v is None or isinstance(v, dict) for v in values):
+        return values
+    arrays = [np.asarray(v, dtype=dtype) for v in values]
+    if any(a.dtype == object for a in arrays):
+        return values
+    if len(set(a.shape for a in arrays)) <= 1:
+        return np.array(arrays, dtype=dtype)
+    if len(set(a.ndim for a in arrays)) > 1:
+        return values
+    return Ragged.fromList(arrays, dtype)
+
+
+class VolpyEstimates(object):
+    """ Estimates of VOLPY.fit held by columns with one row per cell and accessed like a
+        dictionary, e.g. estimates['trace'][n] or estimates['spikeTimes'][n]. Columns are
+        converted on assignment: 'trace' to a float32 matrix, which may be memory mapped,
+        'spikeTimes' to int32 Ragged, and the other fields as in _toColumn. Columns saved
+        to a file are read only when first accessed
+    """
+    dtypes = {'trace': np.float32, 'spikeTimes': np.int32}
+
+    def __init__(self, columns=None):
+        """
+            columns: dict
+                a list or an array with one value per cell for every field
+        """
+        self.columns = {}
+        self.source = None
+        self.sourceFields = {}
+        for key, values in (columns or {}).items():
+            self[key] = values
+
+    def __setitem__(self, key, values):
+        self.columns[key] = _toColumn(values, self.dtypes.get(key))
+
+    def __getitem__(self, key):
+        if key not in self.columns and key in self.sourceFields:
+            self.columns[key] = self._read(key, self.sourceFields[key])
+        return self.columns[key]
+
+    def __contains__(self, key):
+        return key in self.columns or key in self.sourceFields
+
+    def __len__(self):
+        return len(self['cellN']) if 'cellN' in self else 0
+
+    def keys(self):
+        return list(self.columns) + [key for key in self.sourceFields if key not in self.columns]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    @classmethod
+    def fromStore(cls, store, cellNs, fields, rename=None):
+        """ Estimates of the given cells of an EstimatesStore, loading one cell at a time.
+            The traces are written to trace.npy in the folder of the store and memory mapped
+
+        Args:
+            store: EstimatesStore
+                store written by VOLPY.fit
+
+            cellNs: list
+                cell numbers, the cells missing from the store are skipped
+
+            fields: list of str
+                keys of the output dictionaries
+
+            rename: dict
+                names of the columns of some fields, e.g. {'yFilt': 'trace'}
+
+        Returns:
+            estimates: VolpyEstimates
+        """
+        rename = rename or {}
+        cellNs = [cellN for cellN in cellNs if cellN in store]
+        lists = {field: [] for field in fields}
+        trace = None
+        fname = os.path.join(store.folder, 'trace.npy')
+        for k, cellN in enumerate(cellNs):
+            output = store.load(cellN)
+            for field in fields:
+                if rename.get(field) == 'trace':
+                    if trace is None:
+                        trace = open_memmap(fname + '.tmp', mode='w+', dtype=np.float32,
+                                            shape=(len(cellNs), len(output[field])))
+                    trace[k] = output[field]
+                else:
+                    lists[field].append(output[field])
+            del output
+        estimates = cls()
+        for field in fields:
+            if rename.get(field) == 'trace':
+                if trace is not None:
+                    # the file is replaced, not overwritten, while earlier estimates may still map it
+                    trace.flush()
+                    os.replace(fname + '.tmp', fname)
+                    estimates['trace'] = trace
+                else:
+                    estimates['trace'] = np.zeros((0, 0), dtype=np.float32)
+            else:
+                estimates[rename.get(field, field)] = lists[field]
+        return estimates
+
+    def save(self, fname):
+        """ Save the estimates to an npz file, or to an HDF5 file if the name ends with
+            .h5 or .hdf5. Ragged columns are saved as their data, offsets and shapes, and
+            other objects pickled
+        """
+        arrays = {}
+        kinds = {}
+        for key in self.keys():
+            values = self[key]
+            if isinstance(values, Ragged):
+                kinds[key] = 'ragged'
+                arrays[key + '/data'] = values.data
+                arrays[key + '/offsets'] = values.offsets
+                arrays[key + '/shapes'] = values.shapes
+            elif isinstance(values, np.ndarray):
+                kinds[key] = 'dense'
+                arrays[key] = values
+            else:
+                kinds[key] = 'object'
+                arrays[key] = np.frombuffer(pickle.dumps(values, protocol=pickle.HIGHEST_PROTOCOL), dtype=np.uint8)
+        arrays['kinds'] = np.frombuffer(json.dumps(kinds).encode(), dtype=np.uint8)
+        if fname.endswith(('.h5', '.hdf5')):
+            import h5py
+            with h5py.File(fname, 'w') as f:
+                for key, value in arrays.items():
+                    f.create_dataset(key, data=value)
+        else:
+            np.savez(fname, **{key.replace('/', '.'): value for key, value in arrays.items()})
+
+    @classmethod
+    def load(cls, fname):
+        """ Estimates saved by save; the columns are read when first accessed, so the file
+            should stay in place while the estimates are used
+        """
+        estimates = cls()
+        if fname.endswith(('.h5', '.hdf5')):
+            import h5py
+            estimates.source = h5py.File(fname, 'r')
+            estimates.sep = '/'
+        else:
+            estimates.source = np.load(fname)
+            estimates.sep = '.'
+        estimates.sourceFields = json.loads(bytes(np.asarray(estimates.source['kinds'])).decode())
+        return estimates
+
+    def _read(self, key, kind):
+        def read(name):
+            return np.asarray(self.source[name][()] if self.sep == '/' else self.source[name])
+        if kind == 'ragged':
+            return Ragged(*[read(key + self.sep + part) for part in ['data', 'offsets', 'shapes']])
+        elif kind == 'dense':
+            return read(key)
+        else:
+            return pickle.loads(read(key).tobytes())
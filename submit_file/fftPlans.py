@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Real FFTs of single signals through FFTW plans which are built once per process, length
+and dtype and reused by every cell processed by the process, with the FFTW wisdom shared
+between the processes through a file. Batches of signals go through scipy.fft, whose
+plan cache is bounded, so that the memory held by the plans does not depend on how many
+batch sizes and threads a process has seen.
+"""
+import numpy as np
+import os
+import pickle
+import threading
+import pyfftw
+from scipy import fft
+
+# plans of this process for single signals, keyed by kind, length and dtype, with a lock each
+_plans = {}
+
+# guards the creation of the plans
+_lock = threading.Lock()
+
+# wisdom files imported by this process
+_wisdom = set()
+
+
+def _plan(kind, n, dtype):
+    """ FFTW object and its lock for the rfft or irfft of one signal of length n, built
+        with FFTW_MEASURE on first use
+    """
+    dtype = np.dtype(dtype)
+    key = (kind, n, dtype.str)
+    with _lock:
+        if key not in _plans:
+            if kind == 'rfft':
+                a = pyfftw.empty_aligned(n, dtype=dtype)
+                plan = pyfftw.builders.rfft(a, n, planner_effort='FFTW_MEASURE')
+            else:
+                a = pyfftw.empty_aligned(n // 2 + 1, dtype=np.result_type(dtype, np.complex64))
+                plan = pyfftw.builders.irfft(a, n, planner_effort='FFTW_MEASURE')
+            _plans[key] = (plan, threading.Lock())
+        return _plans[key]
+
+
+def rfft(x, n):
+    """ Real FFT of length n along the last axis of x, zero-padded or truncated to n
+
+    Args:
+        x: 1-D or 2-D array
+            real signals along the last axis
+
+        n: int
+            length of the transform
+
+    Returns:
+        X: array
+            n // 2 + 1 frequencies along the last axis
+    """
+    x = np.asarray(x)
+    if x.dtype not in (np.single, np.double):
+        x = x.astype(np.double)
+    if x.size != x.shape[-1]:
+        return fft.rfft(x, n, axis=-1)
+    plan, lock = _plan('rfft', n, x.dtype)
+    # a plan busy in another thread is not waited for
+    if not lock.acquire(blocking=False):
+        return fft.rfft(x, n, axis=-1)
+    try:
+        m = min(n, x.shape[-1])
+        plan.input_array[:m] = x.ravel()[:m]
+        plan.input_array[m:] = 0
+        return np.reshape(plan().copy(), x.shape[:-1] + (n // 2 + 1,))
+    finally:
+        lock.release()
+
+
+def irfft(X, n):
+    """ Inverse of rfft, real signals of length n along the last axis
+    """
+    X = np.asarray(X)
+    if X.dtype not in (np.csingle, np.cdouble):
+        X = X.astype(np.cdouble)
+    if X.size != X.shape[-1]:
+        return fft.irfft(X, n, axis=-1)
+    plan, lock = _plan('irfft', n, np.single if X.dtype == np.csingle else np.double)
+    if not lock.acquire(blocking=False):
+        return fft.irfft(X, n, axis=-1)
+    try:
+        plan.input_array[:] = X.ravel()
+        return np.reshape(plan().copy(), X.shape[:-1] + (n,))
+    finally:
+        lock.release()
+
+
+def loadWisdom(fname):
+    """ Import the FFTW wisdom saved by saveWisdom, once per process
+
+    Args:
+        fname: str or None
+            wisdom file; nothing is done if None or missing
+    """
+    if fname is None or fname in _wisdom or not os.path.exists(fname):
+        return
+    with open(fname, 'rb') as f:
+        pyfftw.import_wisdom(pickle.load(f))
+    _wisdom.add(fname)
+
+
+def saveWisdom(fname, lengths):
+    """ Plan the rfft and irfft of the given lengths in double precision, on top of the
+        wisdom already in fname, and save the wisdom so that the workers load it at startup
+        instead of measuring the plans again
+
+    Args:
+        fname: str
+            wisdom file
+
+        lengths: list
+            lengths of the transforms
+    """
+    loadWisdom(fname)
+    for n in lengths:
+        _plan('rfft', n, np.double)
+        _plan('irfft', n, np.double)
+    with open(fname, 'wb') as f:
+        pickle.dump(pyfftw.export_wisdom(), f)
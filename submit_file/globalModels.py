@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Models of the whole field of view which are computed once per movie in VOLPY.fit
+and shared by all the cells processed by volspike.
+"""
+import numpy as np
+import os
+from skimage.morphology import dilation
+from skimage.morphology import disk
+import caiman as cm
+from .movieIO import companionNames, loadTiled, lowpassFrames, saveTiled, tiledName
+from .spikePursuit import highpassVideo
+
+
+def backgroundMask(ROIs, censorSize, dims):
+    """ Pixels of the field of view which are far from every ROI
+
+    Args:
+        ROIs: 3-d array
+            all region of interests, cells x rows x columns
+
+        censorSize: int
+            number of pixels surrounding the ROIs to censor
+
+        dims: tuple
+            dimensions of the movie
+
+    Returns:
+        mask: 1-D boolean array
+            True for background pixels, in the pixel order of the memory map file
+    """
+    censored = np.zeros(ROIs.shape[1:], dtype=bool)
+    for bw in ROIs:
+        censored |= (dilation(bw, disk(censorSize)) > 0)
+    if ROIs.shape[1:] == tuple(dims[::-1]) and ROIs.shape[1:] != tuple(dims):
+        censored = censored.T
+    return ~censored.ravel(order='F')
+
+
+def highpassBlocks(fnames, fr, tau_lp, pixels, blockSize=4096):
+    """ Iterate over the mean-subtracted, high-passed movie in blocks of pixels
+
+    Args:
+        fnames: str
+            name of the memory map file
+
+        fr: int
+            sample rate of the movie
+
+        tau_lp: int
+            time window for lowpass filter (seconds)
+
+        pixels: 1-D array
+            indices of the pixels to read, in the pixel order of the memory map file
+
+        blockSize: int
+            number of pixels per block
+
+    Returns:
+        iterator of (index, block) where block is the frames x pixels data of pixels[index]
+    """
+    Yr, dims, T = cm.load_memmap(fnames)
+    for i in range(0, len(pixels), blockSize):
+        p = pixels[i:i + blockSize]
+        data = np.array(Yr[p[0]:p[-1] + 1], dtype=np.single)[p - p[0]]
+        data -= np.mean(data, axis=1)[:, np.newaxis]
+        yield slice(i, i + len(p)), highpassVideo(data, 1 / tau_lp, fr, nThreads=None).T
+
+
+def randomizedSVD(blocks, nPixels, rank, nOversample=10, nPowerIter=1, seed=0):
+    """ Randomized truncated SVD of a frames x pixels matrix which is streamed in blocks
+        of pixels, so that it never needs to be in memory at once. Every pass over the
+        data calls blocks() again, nPowerIter + 2 passes are done in total.
+
+    Args:
+        blocks: function
+            returns an iterator of (index, block), block being the columns index of the matrix
+
+        nPixels: int
+            number of columns of the matrix
+
+        rank: int
+            number of singular vectors
+
+        nOversample: int
+            number of additional random vectors
+
+        nPowerIter: int
+            number of power iterations
+
+        seed: int
+            seed of the random projection
+
+    Returns:
+        U: 2-D array, frames x rank
+        S: 1-D array, rank
+        V: 2-D array, pixels x rank
+    """
+    omega = np.random.RandomState(seed).randn(nPixels, rank + nOversample).astype(np.single)
+    Y = None
+    for index, block in blocks():
+        Y = np.matmul(block, omega[index]) if Y is None else Y + np.matmul(block, omega[index])
+    Q = np.linalg.qr(Y)[0]
+
+    for i in range(nPowerIter):
+        Y = np.zeros_like(Q)
+        for index, block in blocks():
+            Y += np.matmul(block, np.matmul(block.T, Q))
+        Q = np.linalg.qr(Y)[0]
+
+    Bt = np.zeros((nPixels, Q.shape[1]), dtype=np.single)
+    for index, block in blocks():
+        Bt[index] = np.matmul(block.T, Q)
+    Ub, S, Vt = np.linalg.svd(Bt.T, full_matrices=False)
+    return np.matmul(Q, Ub[:, :rank]), S[:rank], Vt[:rank].T
+
+
+def computeGlobalBackground(fnames, fr, ROIs, censorSize, tau_lp, nPC, fname_out=None):
+    """ Compute the principal components of the high-passed field of view with all the ROIs
+        masked out, once per movie. volspike slices them for the background of each cell
+        instead of running an SVD on every crop.
+
+    Args:
+        fnames: str
+            name of the memory map file
+
+        fr: int
+            sample rate of the movie
+
+        ROIs: 3-d array
+            all region of interests
+
+        censorSize: int
+            number of pixels surrounding the ROIs to censor from the background
+
+        tau_lp: int
+            time window for lowpass filter (seconds)
+
+        nPC: int
+            number of global principal components
+
+        fname_out: str
+            name of the file saving the model, by default next to the memory map file
+
+    Returns:
+        fname_out: str
+            name of the .npz file with the temporal components 'U', the singular values 'S'
+            and the spatial components 'V', the latter as an image in the orientation of the ROIs
+    """
+    Yr, dims, T = cm.load_memmap(fnames)
+    mask = backgroundMask(ROIs, censorSize, dims)
+    pixels = np.where(mask)[0]
+    U, S, V = randomizedSVD(lambda: highpassBlocks(fnames, fr, tau_lp, pixels), len(pixels), nPC)
+
+    Vfull = np.zeros((len(mask), nPC), dtype=np.single)
+    Vfull[pixels] = V
+    Vfull = np.reshape(Vfull, tuple(dims) + (nPC,), order='F')
+    if ROIs.shape[1:] != tuple(dims):
+        Vfull = Vfull.transpose([1, 0, 2])
+
+    if fname_out is None:
+        fname_out = os.path.splitext(fnames)[0] + '_bgPC.npz'
+    np.savez(fname_out, U=U, S=S, V=Vfull)
+    return fname_out
+
+
+def computeGlobalSignal(fnames, fr, ROIs, censorSize, tau_lp, nPC):
+    """ Estimate the signal shared by the entire field of view, once per recording, as the
+        leading temporal components of a streaming low-rank decomposition of the mean-subtracted,
+        high-passed memory map file. The ROIs are masked out as in computeGlobalBackground,
+        otherwise the components would contain the activity of the cells and subtracting them
+        would remove the spikes from their traces
+
+    Args:
+        fnames: str
+            name of the memory map file
+
+        fr: int
+            sample rate of the movie
+
+        ROIs: 3-d array
+            all region of interests
+
+        censorSize: int
+            number of pixels surrounding the ROIs to censor
+
+        tau_lp: int
+            time window for lowpass filter (seconds)
+
+        nPC: int
+            number of global components
+
+    Returns:
+        U: 2-D array
+            orthonormal global temporal components, frames x nPC
+    """
+    Yr, dims, T = cm.load_memmap(fnames)
+    pixels = np.where(backgroundMask(ROIs, censorSize, dims))[0]
+    U, S, V = randomizedSVD(lambda: highpassBlocks(fnames, fr, tau_lp, pixels), len(pixels), nPC)
+    return U
+
+
+def saveHighpassed(fnames, fr, tau_lp, tileSize=32, nLowpass=None, fname_out=None, backend='iir',
+                   fnames_tiled=None):
+    """ High-pass the whole movie once and store it, mean-subtracted and in float32, in the
+        tiled format of movieIO.saveTiled, so that volspike reads its crops already filtered
+        instead of filtering every context window again. The mean image and the low-passed
+        movie, sampled at nLowpass frames (movieIO.lowpassFrames), are stored next to it for the computation of F0.
+        Pass the tiled file as fnames_hp. A memory map file in order F, as written by motion correction, is
+        read from its tiled file, since every tile of it would span all the pages of the movie.
+
+    Args:
+        fnames: str
+            name of the memory map file
+
+        fr: int
+            sample rate of the movie
+
+        tau_lp: int
+            time window for lowpass filter (seconds)
+
+        tileSize: int
+            size of the tiles in pixels
+
+        nLowpass: int
+            number of frames of the stored low-passed movie, by default 8 per tau_lp
+
+        fname_out: str
+            name of the tiled file, by default next to the memory map file
+
+        backend: str, 'iir' or 'fft'
+            backend of the high-pass filter, see highpassVideo
+
+        fnames_tiled: str
+            tiled file of the movie written by movieIO.saveTiled to read the tiles from, in which case its
+            tile size is used; for a memory map file in order F it is written by saveTiled if None
+
+    Returns:
+        fname_out: str
+            name of the tiled file of the high-passed movie
+    """
+    Yr, dims, T = cm.load_memmap(fnames)
+    d1, d2 = dims[0], dims[1]
+    if fnames_tiled is None and not Yr.flags['C_CONTIGUOUS']:
+        # every frame is contiguous, the tiles are written once by reading blocks of frames
+        fnames_tiled = saveTiled(fnames, tileSize)
+    tilesIn = None
+    if fnames_tiled is not None:
+        tilesIn, _, _, tileSize = loadTiled(fnames_tiled)
+    if fname_out is None:
+        fname_out = tiledName(os.path.splitext(fnames)[0] + '_hp', dims, T, tileSize)
+    if nLowpass is None:
+        nLowpass = int(np.ceil(8 * T / (fr * tau_lp)))
+    nLowpass = max(2, min(nLowpass, T))
+    frames = lowpassFrames(T, nLowpass)
+    fname_mean, fname_lowpass = companionNames(fname_out)
+
+    tiles = np.memmap(fname_out, mode='w+', dtype=np.single,
+                      shape=(-(-d1 // tileSize), -(-d2 // tileSize), T, tileSize, tileSize))
+    meanIM = np.zeros((d1, d2), dtype=np.single)
+    lowpass = np.lib.format.open_memmap(fname_lowpass, mode='w+', dtype=np.single, shape=(nLowpass, d1, d2))
+    for tx in range(tiles.shape[0]):
+        xa, xb = tx * tileSize, min((tx + 1) * tileSize, d1)
+        for ty in range(tiles.shape[1]):
+            ya, yb = ty * tileSize, min((ty + 1) * tileSize, d2)
+            if tilesIn is None:
+                tile = np.zeros((xb - xa, yb - ya, T), dtype=np.single)
+                for y in range(ya, yb):
+                    tile[:, y - ya] = Yr[y * d1 + xa:y * d1 + xb]
+            else:
+                tile = np.ascontiguousarray(tilesIn[tx, ty, :, :xb - xa, :yb - ya].transpose([1, 2, 0]))
+            tile = np.reshape(tile, (-1, T))
+            mean = np.mean(tile, axis=1)
+            tile -= mean[:, np.newaxis]
+            tile_hp = highpassVideo(tile, 1 / tau_lp, fr, nThreads=None, backend=backend)
+            tile -= tile_hp
+            block = np.zeros((T, tileSize, tileSize), dtype=np.single)
+            block[:, :xb - xa, :yb - ya] = np.reshape(tile_hp.T, (T, xb - xa, yb - ya))
+            tiles[tx, ty] = block
+            meanIM[xa:xb, ya:yb] = np.reshape(mean, (xb - xa, yb - ya))
+            lowpass[:, xa:xb, ya:yb] = np.reshape(tile[:, frames].T, (nLowpass, xb - xa, yb - ya))
+    tiles.flush()
+    lowpass.flush()
+    del tiles, lowpass
+    np.save(fname_mean, meanIM)
+    return fname_out
+
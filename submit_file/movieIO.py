@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Reading the context windows of the cells from the movie, and a tiled file format of the
+movie for reading them with a few contiguous reads.
+"""
+import numpy as np
+import os
+import re
+import caiman as cm
+from .sharedArrays import emptySharedArray
+
+# movies opened by this process, kept open so that the tasks of a persistent worker reuse them
+_movies = {}
+
+
+def extractCrops(fnames, windows, roiShape, maxBlockBytes=2 ** 28):
+    """ Extract the context windows of many cells in a single pass over the memory map file.
+        The file is streamed in blocks along its contiguous axis (blocks of pixel columns for
+        files in order C, blocks of frames for files in order F) and every block is scattered
+        into the windows it overlaps, which live in shared memory so that the workers can
+        attach to them without copying.
+
+    Args:
+        fnames: str
+            name of the memory map file, or of the tiled file
+
+        windows: dict
+            (Xinds, Yinds) rows and columns of the window of each cell, keyed by cell number,
+            in the orientation of the ROIs
+
+        roiShape: tuple
+            shape of the ROIs, either the dimensions of the movie or their transpose
+
+        maxBlockBytes: int
+            size of the blocks read from the file
+
+    Returns:
+        shms: list of SharedMemory
+            the segments, to be closed and unlinked by the caller
+
+        crops: dict
+            shared memory descriptors of the frames x rows x columns windows, keyed by cell number
+    """
+    if fnames.endswith('.tmap'):
+        tiles, dims, T, tileSize = loadTiled(fnames)
+    else:
+        Yr, dims, T = cm.load_memmap(fnames)
+    d1 = dims[0]
+    transposed = tuple(roiShape) != tuple(dims)
+    shms = []
+    crops = {}
+    views = {}
+    for cellN, (Xinds, Yinds) in windows.items():
+        shm, crops[cellN] = emptySharedArray((T, len(Xinds), len(Yinds)), np.single)
+        shms.append(shm)
+        views[cellN] = np.ndarray(crops[cellN]['shape'], dtype=np.single, buffer=shm.buf)
+
+    if fnames.endswith('.tmap'):
+        # every window is already a few contiguous reads
+        for cellN, (Xinds, Yinds) in windows.items():
+            views[cellN][:] = loadTiledCrop(fnames, Xinds, Yinds, roiShape)
+        del views
+        return shms, crops
+
+    # window of every cell in memory map coordinates, x being the contiguous pixel axis
+    bounds = {}
+    for cellN, (Xinds, Yinds) in windows.items():
+        rows, cols = (Xinds, Yinds) if not transposed else (Yinds, Xinds)
+        bounds[cellN] = (rows[0], rows[-1] + 1, cols[0], cols[-1] + 1)
+
+    if Yr.flags['C_CONTIGUOUS']:
+        # every pixel is contiguous in time, read blocks of columns of pixels
+        step = max(1, maxBlockBytes // (d1 * T * Yr.dtype.itemsize))
+        for y0 in range(0, dims[1], step):
+            y1 = min(y0 + step, dims[1])
+            block = np.reshape(np.array(Yr[y0 * d1:y1 * d1]), (y1 - y0, d1, T))
+            for cellN, (x_a, x_b, y_a, y_b) in bounds.items():
+                for y in range(max(y0, y_a), min(y1, y_b)):
+                    if not transposed:
+                        views[cellN][:, :, y - y_a] = block[y - y0, x_a:x_b].T
+                    else:
+                        views[cellN][:, y - y_a, :] = block[y - y0, x_a:x_b].T
+    else:
+        # every frame is contiguous, read blocks of frames
+        step = max(1, maxBlockBytes // (Yr.shape[0] * Yr.dtype.itemsize))
+        for t0 in range(0, T, step):
+            t1 = min(t0 + step, T)
+            block = np.reshape(np.array(Yr[:, t0:t1]).T, (t1 - t0, dims[1], d1))    # frames x y x x
+            for cellN, (x_a, x_b, y_a, y_b) in bounds.items():
+                if not transposed:
+                    views[cellN][t0:t1] = block[:, y_a:y_b, x_a:x_b].transpose([0, 2, 1])
+                else:
+                    views[cellN][t0:t1] = block[:, y_a:y_b, x_a:x_b]
+    del views
+    return shms, crops
+
+
+def tiledName(base_name, dims, T, tileSize):
+    """ Name of the tiled file, which encodes its dimensions like the memory map files
+    """
+    return '{0}_tiled__d1_{1}_d2_{2}_tile_{3}_frames_{4}_.tmap'.format(base_name, dims[0], dims[1], tileSize, T)
+
+
+def loadTiled(fname):
+    """ Open a tiled file written by saveTiled
+
+    Args:
+        fname: str
+            name of the tiled file
+
+    Returns:
+        tiles: memmap
+            tiles along x x tiles along y x frames x tileSize x tileSize, each tile being contiguous
+
+        dims: tuple
+            dimensions of the movie
+
+        T: int
+            number of frames
+
+        tileSize: int
+            size of the tiles in pixels
+    """
+    d1, d2, tileSize, T = [int(n) for n in re.search(
+        r'_d1_(\d+)_d2_(\d+)_tile_(\d+)_frames_(\d+)_\.tmap$', fname).groups()]
+    shape = (-(-d1 // tileSize), -(-d2 // tileSize), T, tileSize, tileSize)
+    tiles = np.memmap(fname, mode='r', dtype=np.single, shape=shape)
+    return tiles, (d1, d2), T, tileSize
+
+
+def openMovie(fname):
+    """ Open a memory map file with cm.load_memmap, or a tiled file with loadTiled, once per
+        process; the file is opened again if it was modified since
+
+    Args:
+        fname: str
+            name of the memory map file or of the tiled file
+
+    Returns:
+        movie: tuple
+            as returned by cm.load_memmap or loadTiled
+    """
+    key = (fname, os.path.getmtime(fname))
+    if key not in _movies:
+        for old in [k for k in _movies if k[0] == fname]:
+            del _movies[old]
+        _movies[key] = loadTiled(fname) if fname.endswith('.tmap') else cm.load_memmap(fname)
+    return _movies[key]
+
+
+def saveTiled(fnames, tileSize=32, fname_out=None, maxBlockBytes=2 ** 28):
+    """ Store the movie in tiles of tileSize x tileSize pixels x all frames, each tile being
+        contiguous on disk, so that the context window of a cell is read with a few contiguous
+        reads. Run it once after motion correction and pass the tiled file as fnames_tiled.
+
+    Args:
+        fnames: str
+            name of the memory map file
+
+        tileSize: int
+            size of the tiles in pixels
+
+        fname_out: str
+            name of the tiled file, by default next to the memory map file
+
+        maxBlockBytes: int
+            size of the blocks of frames read at once from files in order F
+
+    Returns:
+        fname_out: str
+            name of the tiled file
+    """
+    Yr, dims, T = cm.load_memmap(fnames)
+    d1, d2 = dims[0], dims[1]
+    if fname_out is None:
+        fname_out = tiledName(os.path.splitext(fnames)[0], dims, T, tileSize)
+    tiles = np.memmap(fname_out, mode='w+', dtype=np.single,
+                      shape=(-(-d1 // tileSize), -(-d2 // tileSize), T, tileSize, tileSize))
+
+    if Yr.flags['C_CONTIGUOUS']:
+        # every pixel is contiguous in time, each tile is tileSize chunks of pixels
+        for tx in range(tiles.shape[0]):
+            xa, xb = tx * tileSize, min((tx + 1) * tileSize, d1)
+            for ty in range(tiles.shape[1]):
+                ya, yb = ty * tileSize, min((ty + 1) * tileSize, d2)
+                tile = np.zeros((T, tileSize, tileSize), dtype=np.single)
+                for y in range(ya, yb):
+                    tile[:, :xb - xa, y - ya] = Yr[y * d1 + xa:y * d1 + xb].T
+                tiles[tx, ty] = tile
+    else:
+        # every frame is contiguous, read blocks of frames
+        step = max(1, maxBlockBytes // (Yr.shape[0] * Yr.dtype.itemsize))
+        for t0 in range(0, T, step):
+            t1 = min(t0 + step, T)
+            block = np.reshape(np.array(Yr[:, t0:t1]).T, (t1 - t0, d2, d1)).transpose([0, 2, 1])    # frames x x x y
+            for tx in range(tiles.shape[0]):
+                xa, xb = tx * tileSize, min((tx + 1) * tileSize, d1)
+                for ty in range(tiles.shape[1]):
+                    ya, yb = ty * tileSize, min((ty + 1) * tileSize, d2)
+                    tiles[tx, ty, t0:t1, :xb - xa, :yb - ya] = block[:, xa:xb, ya:yb]
+    tiles.flush()
+    del tiles
+    return fname_out
+
+
+def loadTiledCrop(fname, Xinds, Yinds, roiShape):
+    """ Read the context window of a cell from a tiled file, reading only the tiles under it
+
+    Args:
+        fname: str
+            name of the tiled file
+
+        Xinds, Yinds: 1-D arrays
+            rows and columns of the window in the orientation of the ROIs
+
+        roiShape: tuple
+            shape of the ROIs, either the dimensions of the movie or their transpose
+
+    Returns:
+        data: 3-D array
+            frames x rows x columns
+    """
+    tiles, dims, T, tileSize = openMovie(fname)
+    transposed = tuple(roiShape) != tuple(dims)
+    rows, cols = (Xinds, Yinds) if not transposed else (Yinds, Xinds)
+    x0, x1, y0, y1 = rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+    data = np.empty((T, x1 - x0, y1 - y0), dtype=np.single)
+    for tx in range(x0 // tileSize, (x1 - 1) // tileSize + 1):
+        xa, xb = max(x0, tx * tileSize), min(x1, (tx + 1) * tileSize)
+        for ty in range(y0 // tileSize, (y1 - 1) // tileSize + 1):
+            ya, yb = max(y0, ty * tileSize), min(y1, (ty + 1) * tileSize)
+            data[:, xa - x0:xb - x0, ya - y0:yb - y0] = \
+                tiles[tx, ty, :, xa - tx * tileSize:xb - tx * tileSize, ya - ty * tileSize:yb - ty * tileSize]
+    if transposed:
+        data = np.ascontiguousarray(data.transpose([0, 2, 1]))
+    return data
+
+
+def companionNames(fname):
+    """ Names of the mean image and of the low-passed movie stored next to a high-passed
+        tiled file by globalModels.saveHighpassed
+    """
+    base = os.path.splitext(fname)[0]
+    return base + '_mean.npy', base + '_lowpass.npy'
+
+
+def lowpassFrames(T, nLowpass):
+    """ Frames at which the low-passed movie is stored by globalModels.saveHighpassed
+    """
+    return np.round(np.linspace(0, T - 1, nLowpass)).astype(int)
+
+
+def loadHighpassedCrop(fname, Xinds, Yinds, roiShape):
+    """ Read the mean image and the low-passed movie of the context window of a cell from
+        the companion files of a high-passed tiled file
+
+    Args:
+        fname: str
+            name of the high-passed tiled file
+
+        Xinds, Yinds: 1-D arrays
+            rows and columns of the window in the orientation of the ROIs
+
+        roiShape: tuple
+            shape of the ROIs, either the dimensions of the movie or their transpose
+
+    Returns:
+        meanIM: 2-D array
+            mean image of the window
+
+        lowpass: 3-D array
+            low-passed movie of the window at the stored frames
+
+        frames: 1-D array
+            the stored frames
+    """
+    fname_mean, fname_lowpass = companionNames(fname)
+    meanIM = np.load(fname_mean, mmap_mode='r')
+    lowpass = np.load(fname_lowpass, mmap_mode='r')
+    transposed = tuple(roiShape) != tuple(meanIM.shape)
+    rows, cols = (Xinds, Yinds) if not transposed else (Yinds, Xinds)
+    meanIM = np.array(meanIM[rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1])
+    lowpass = np.array(lowpass[:, rows[0]:rows[-1] + 1, cols[0]:cols[-1] + 1])
+    if transposed:
+        meanIM = meanIM.T
+        lowpass = lowpass.transpose([0, 2, 1])
+    frames = lowpassFrames(loadTiled(fname)[2], lowpass.shape[0])
+    return meanIM, lowpass, frames
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process pool for running VOLPY.fit on a single machine without a caiman cluster. The
+workers are persistent, so the movie, the shared arrays and the FFT plans opened by one
+task are reused by the next ones. Their BLAS libraries are limited to a few threads each,
+and the workers are replaced once one of them grows beyond a memory high-water mark.
+"""
+import logging
+import multiprocessing
+import os
+import psutil
+from concurrent.futures import ProcessPoolExecutor
+
+# thread limits of the BLAS libraries of this worker, kept alive for the life of the process
+_blasLimits = None
+
+
+def _initWorker(blasThreads):
+    """ Limit the threads of the BLAS libraries of a new worker
+    """
+    global _blasLimits
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'BLIS_NUM_THREADS',
+                'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        os.environ[var] = str(blasThreads)
+    # the variables only reach the libraries loaded from now on, threadpoolctl also the loaded ones
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        return
+    _blasLimits = threadpool_limits(limits=blasThreads, user_api='blas')
+
+
+def _runTask(fn, args):
+    """ Run a task and measure the private memory of the worker afterwards
+    """
+    result = fn(*args)
+    info = psutil.Process().memory_info()
+    # pages of the memory map files are shared with the page cache and not counted
+    return result, info.rss - getattr(info, 'shared', 0)
+
+
+class PoolResult(object):
+    """ Asynchronous result of VolpyPool.apply_async, with the ready() and get() of the
+        results of a multiprocessing pool
+    """
+    def __init__(self, future):
+        self.future = future
+
+    def ready(self):
+        return self.future.done()
+
+    def get(self, timeout=None):
+        return self.future.result(timeout)[0]
+
+
+class VolpyPool(object):
+    """ Pool of persistent worker processes built on concurrent.futures, to be passed to
+        VOLPY as dview. Combined with sharedCrops and doGlobalSubtract, the data broadcast
+        by VOLPY.fit to the workers goes through shared memory
+    """
+    def __init__(self, n_processes=None, blasThreads=1, maxMemory=None, context=None):
+        """
+            n_processes: int
+                number of worker processes, the number of cpus if None
+
+            blasThreads: int
+                number of threads of the BLAS libraries in every worker
+
+            maxMemory: float
+                high-water mark of the private memory of a worker in bytes; once a worker
+                goes beyond it, the workers are replaced after their current tasks. None
+                never replaces them
+
+            context: str
+                multiprocessing start method, e.g. 'spawn' or 'forkserver'; the default one if None
+        """
+        self.n_processes = n_processes or os.cpu_count()
+        self.blasThreads = blasThreads
+        self.maxMemory = maxMemory
+        self.context = None if context is None else multiprocessing.get_context(context)
+        self.recycle = False
+        self.executor = None
+        self._start()
+
+    def _start(self):
+        self.executor = ProcessPoolExecutor(max_workers=self.n_processes, mp_context=self.context,
+                                            initializer=_initWorker, initargs=(self.blasThreads,))
+        self.recycle = False
+
+    def _check(self, future):
+        if self.maxMemory is not None and not future.cancelled() and future.exception() is None:
+            if future.result()[1] > self.maxMemory:
+                self.recycle = True
+
+    def apply_async(self, fn, args=()):
+        """ Submit fn(*args) to the workers
+
+        Returns:
+            result: PoolResult
+                result with ready() and get()
+        """
+        if self.recycle:
+            # the old workers finish their current tasks and exit
+            logging.info('A worker went beyond {0:.1f} GB, replacing the workers'.format(self.maxMemory / 2 ** 30))
+            self.executor.shutdown(wait=False)
+            self._start()
+        future = self.executor.submit(_runTask, fn, tuple(args))
+        future.add_done_callback(self._check)
+        return PoolResult(future)
+
+    def map_sync(self, fn, iterable):
+        """ fn applied to every element of iterable by the workers, as the map_sync of ipyparallel
+        """
+        return [result.get() for result in [self.apply_async(fn, (x,)) for x in iterable]]
+
+    def close(self):
+        """ Shut down the workers once their tasks are done
+        """
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
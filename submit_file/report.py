@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Rendering of the diagnostic figures of volspike outside of the compute path. With
+diagnostics enabled, volspike stores the arrays of its figures in the estimates and
+renderReport draws them afterwards, in parallel and without a display.
+"""
+import numpy as np
+import os
+from matplotlib.figure import Figure
+
+
+def plotDiagnostics(diagnostics, fname):
+    """ Draw the diagnostic figures of one cell into a single image file
+
+    Args:
+        diagnostics: dict
+            arrays stored by volspike when diagnostics is enabled
+
+        fname: str
+            name of the image file
+
+    Returns:
+        fname: str
+            name of the image file
+    """
+    d = diagnostics
+    fig = Figure(figsize=(12, 14))
+    grid = fig.add_gridspec(4, 2)
+
+    ax = fig.add_subplot(grid[0, 0])
+    ax.hist(d['pks'], 500)
+    ax.axvline(x=d['thresh'], c='r')
+    ax.set_title('raw data')
+    ax = fig.add_subplot(grid[0, 1])
+    ax.hist(d['pks2'], 500)
+    ax.axvline(x=d['thresh2'], c='r')
+    ax.set_title('after matched filter')
+
+    ax = fig.add_subplot(grid[1, 0])
+    if len(d['PTD']):
+        ax.plot(np.transpose(d['PTD']), c=[0.5, 0.5, 0.5])
+    ax.plot(d['PTA'], c='black', linewidth=2)
+    ax.set_title('Peak-triggered average')
+    ax = fig.add_subplot(grid[1, 1])
+    ax.imshow(d['spatialFilter'])
+    ax.set_title('Spatial filter')
+
+    top = np.max(d['datafilt'])
+    for cell, trace, title in [(grid[2, :], d['data'], 'trace'), (grid[3, 0], d['datafilt'], 'after matched filter')]:
+        ax = fig.add_subplot(cell)
+        ax.plot(trace)
+        ax.plot(d['locs'], top * 1.1 * np.ones(d['locs'].shape), color='r', marker='o', fillstyle='none',
+                linestyle='none')
+        ax.plot(d['spikeTimes'], top * np.ones(d['spikeTimes'].shape), color='g', marker='o', fillstyle='none',
+                linestyle='none')
+        ax.set_title(title)
+
+    ax = fig.add_subplot(grid[3, 1])
+    if 'trace' in d:
+        ax.plot(d['trace'])
+        ax.plot(d['background'])
+    ax.set_title('Denoised trace vs background')
+
+    fig.suptitle('cell {0}'.format(d['cellN']))
+    fig.tight_layout()
+    fig.savefig(fname)
+    return fname
+
+
+def renderCell(pars):
+    """ plotDiagnostics for pars = [diagnostics, fname], the task of renderReport
+    """
+    return plotDiagnostics(pars[0], pars[1])
+
+
+def renderReport(diagnostics, folder, dview=None, fmt='png'):
+    """ Draw the diagnostic figures of all cells, one image file per cell, in parallel
+
+    Args:
+        diagnostics: list of dict
+            vpy.estimates['diagnostics'] of a fit with diagnostics enabled
+
+        folder: str
+            folder of the image files, created if needed
+
+        dview: Direct View object
+            for parallelization pruposes when using ipyparallel or multiprocessing
+
+        fmt: str
+            format of the image files
+
+    Returns:
+        fnames: list of str
+            names of the image files
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    args_in = [[d, os.path.join(folder, 'cell_{0}.{1}'.format(d['cellN'], fmt))]
+               for d in diagnostics if d is not None]
+    if 'multiprocessing' in str(type(dview)):
+        return dview.map_async(renderCell, args_in).get(4294967)
+    elif dview is not None:
+        return dview.map_sync(renderCell, args_in)
+    else:
+        return list(map(renderCell, args_in))
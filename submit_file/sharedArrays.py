@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Arrays in shared memory, used to broadcast data computed once in VOLPY.fit to all
+the worker processes of one machine without pickling it for every cell.
+"""
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+# segments attached by this process, kept open so that repeated tasks reuse them
+_attached = {}
+
+
+def toSharedMemory(array):
+    """ Copy an array into a new shared memory segment
+
+    Args:
+        array: ndarray
+            the array to share
+
+    Returns:
+        shm: SharedMemory
+            the segment; the creator must close() and unlink() it when done
+
+        descriptor: dict
+            name, shape and dtype of the array, small enough to be sent to the workers
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[:] = array
+    return shm, {'name': shm.name, 'shape': array.shape, 'dtype': array.dtype.str, 'tracker': _trackerPid()}
+
+
+def emptySharedArray(shape, dtype):
+    """ Allocate an uninitialized array in a new shared memory segment
+
+    Args:
+        shape: tuple
+            shape of the array
+
+        dtype: dtype
+            type of the array
+
+    Returns:
+        shm: SharedMemory
+            the segment; the creator must close() and unlink() it when done
+
+        descriptor: dict
+            name, shape and dtype of the array
+    """
+    dtype = np.dtype(dtype)
+    shm = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return shm, {'name': shm.name, 'shape': tuple(shape), 'dtype': dtype.str, 'tracker': _trackerPid()}
+
+
+def _trackerPid():
+    """ Process id of the resource tracker of this process, None if it was inherited from
+        a parent which spawned this process
+    """
+    return resource_tracker._resource_tracker._pid
+
+
+def _sharesTracker(descriptor):
+    """ Whether this process reports to the resource tracker of the creator of the segment:
+        the creator itself, and the processes it forked or spawned
+    """
+    tracker = resource_tracker._resource_tracker
+    if tracker._fd is None:
+        # attaching would start a tracker of this process
+        return False
+    return tracker._pid is None or tracker._pid == descriptor.get('tracker')
+
+
+def attachSharedArray(descriptor):
+    """ Zero-copy view of an array shared with toSharedMemory. The segment stays attached
+        until releaseSharedArrays is called
+
+    Args:
+        descriptor: dict
+            descriptor returned by toSharedMemory
+
+    Returns:
+        array: ndarray
+            read-only view of the shared array
+    """
+    name = descriptor['name']
+    if name not in _attached:
+        try:
+            shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # before python 3.13 attaching registers the segment with the resource tracker.
+            # A tracker of this process alone would unlink it when this process exits, so
+            # the registration is withdrawn; a tracker shared with the creator already holds
+            # the segment, and withdrawing would drop the entry of the creator
+            shared = _sharesTracker(descriptor)
+            shm = shared_memory.SharedMemory(name=name)
+            if not shared:
+                resource_tracker.unregister(shm._name, 'shared_memory')
+        _attached[name] = shm
+    array = np.ndarray(descriptor['shape'], dtype=np.dtype(descriptor['dtype']), buffer=_attached[name].buf)
+    array.flags.writeable = False
+    return array
+
+
+def releaseSharedArrays():
+    """ Detach all the shared arrays attached by this process
+    """
+    for name in list(_attached):
+        try:
+            _attached[name].close()
+            del _attached[name]
+        except BufferError:
+            pass    # a view of the segment is still in use
@@ -6,18 +6,21 @@ Created on Fri Apr 19 14:50:09 2019
 @author: Changjia Cai based on Matlab code provided by Kaspar and Amrita
 """
 import numpy as np
+import os
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from skimage.morphology import dilation
 from skimage.morphology import disk
 from sklearn.linear_model import LinearRegression
-from sklearn.linear_model import Ridge
+from scipy import fft
 from scipy import signal
-from scipy import stats    
+from scipy import sparse
+from scipy.linalg import cho_factor, cho_solve, eigh
 from scipy.sparse.linalg import svds
-import pyfftw
-import cv2
-from caiman.base.movies import movie
-import caiman as cm
+from .estimates import EstimatesStore, movieFolder
+from .fftPlans import irfft, loadWisdom, rfft
+from .movieIO import loadHighpassedCrop, loadTiledCrop, openMovie
+from .sharedArrays import attachSharedArray, releaseSharedArrays
 
 
 # %%
@@ -41,13 +44,17 @@ def volspike(pars):
                 ROIs: 3-d array
                     all region of interests
 
-                weights: 3-d array
-                    spatial weights of different cells generated by previous data blocks as initialization
+                weights: 2-d array, 1-d array or None
+                    spatial filter of the cell found on a previous data block (its output spatialFilter) as
+                    initialization; if given, the raw ROI pass is skipped and only nIterWarm iterations are run.
+                    The regression weights of the previous block (its output weights) are also accepted, but they
+                    are blurred with sigmas[1], which differs from the filter if cross validation chose another sigma
 
                 args: dictionary
 
                     doCrossVal: boolean
-                        whether to use cross validation to optimize regression regularization parameters
+                        whether to use cross validation to optimize regression regularization parameters;
+                        5 folds x 3 sigmas, so 15 eigendecompositions of the regression, each shared by the 3 lambdas
 
                     doGlobalSubtract: boolean
                         whether to subtract the signal which can be predicted by the entire video
@@ -74,6 +81,9 @@ def volspike(pars):
                     nIter: int
                         number of iterations alternating between estimating temporal and spatial filters
 
+                    nIterWarm: int
+                        number of iterations when starting from the spatial weights of a previous block
+
                     localAlign: boolean
 
                     globalAlign: boolean
@@ -82,6 +92,36 @@ def volspike(pars):
                         whether to regress on a high-passed version of the data. Slightly improves detection of spikes,
                         but makes subthreshold unreliable
 
+                    hpThreads: int
+                        number of threads of the high-pass filters of the worker, 1 by default
+
+                    globalSignal: dict or None
+                        shared memory descriptor of the global signal computed by VOLPY.fit, used if doGlobalSubtract
+
+                    fnames_tiled: str or None
+                        tiled copy of the movie written by movieIO.saveTiled; if given, the context window is
+                        read from it instead of from the memory map file
+
+                    fnames_hp: str or None
+                        high-passed movie written by globalModels.saveHighpassed; if given, the context window
+                        is read from it already filtered, and F0 is computed from its mean image and low-passed movie
+
+                    crops: dict or None
+                        shared memory descriptors of the context windows of the cells extracted by VOLPY.fit,
+                        keyed by cell number; if None, the crop is read from the memory map file
+
+                    bgModel: str or None
+                        file of the global background components computed by VOLPY.fit; if None, the background
+                        components are computed from the crop of each cell
+
+                    outputFields: list of str or None
+                        keys of the output dictionary to return, cellN always included; if None, all of them
+
+                    resultsFolder: str or None
+                        folder of the estimates.EstimatesStore of all movies; if given, the output is written to the
+                        store of the movie in it (estimates.movieFolder), with the key keys[cellN] if args has keys, and
+                        only {'cellN': cellN, 'stored': True} is returned
+
         Returns:
             output: a dictionary
                 output including spike times, spatial filters etc
@@ -92,191 +132,333 @@ def volspike(pars):
     bw = pars[3]    
     weights_init = pars[4]    
     args = pars[5]
-    
-    print('Now processing cell number {0}'.format(cellN))
-    
-    doCrossVal = args['doCrossVal']
-    doGlobalSubtract = args['doGlobalSubtract']
+
+    return volspikeGroup([fnames, sampleRate, [[cellN, bw, weights_init]], args])[0]
+
+
+def volspikeGroup(pars):
+    """ Function for finding spikes of a group of neurons whose context windows overlap.
+        The union of their context windows is loaded, mean-subtracted, high-passed and
+        decomposed into background components once, then the ridge regression and spike
+        detection run for every neuron on its own context window.
+
+        Args:
+            pars: list
+                fnames: str
+                    name of the memory map file
+
+                fr: int
+
+                cells: list
+                    [cellN, ROI, weights] of every neuron of the group, as in volspike
+
+                args: dictionary
+                    same as in volspike
+
+        Returns:
+            outputs: list
+                a dictionary for every neuron of the group, as returned by volspike
+    """
+    fnames = pars[0]
+    sampleRate = pars[1]
+    cells = pars[2]
+    args = pars[3]
+
     contextSize = args['contextSize']
     censorSize = args['censorSize']
     nPC_bg = args['nPC_bg']
     tau_lp = args['tau_lp']
     tau_pred = args['tau_pred']
+    highPassRegression = args['highPassRegression']
+    hpBackend = args.get('hpBackend', 'iir')
+    hpThreads = args.get('hpThreads', 1)
+    loadWisdom(args.get('fftWisdom'))
+
+    # extract the union of the context windows
+    roiShape = cells[0][1].shape
+    windows = [contextWindow(bw, contextSize) for _, bw, _ in cells]
+    Xinds = np.arange(min(w[0][0] for w in windows), max(w[0][-1] for w in windows) + 1)
+    Yinds = np.arange(min(w[1][0] for w in windows), max(w[1][-1] for w in windows) + 1)
+    if args.get('crops') is not None:
+        # crop extracted by VOLPY.fit in a single pass over the movie, read from shared memory
+        data = attachSharedArray(args['crops'][cells[0][0]])
+    elif args.get('fnames_hp') is not None:
+        data = loadTiledCrop(args['fnames_hp'], Xinds, Yinds, roiShape)
+    elif args.get('fnames_tiled') is not None:
+        # only the tiles under the context window are read
+        data = loadTiledCrop(args['fnames_tiled'], Xinds, Yinds, roiShape)
+    else:
+        Yr, dims, T = openMovie(fnames)
+        if roiShape == dims:
+            images = np.reshape(Yr.T, [T] + list(dims), order='F')
+        elif roiShape == dims[::-1]:
+            images = np.reshape(Yr.T, [T] + list(dims), order='F').transpose([0, 2, 1])
+        else:
+            print('size of ROI and video does not accrod')
+        data = np.array(images[:, Xinds[0]:Xinds[-1] + 1, Yinds[0]:Yinds[-1] + 1])
+    shape = data.shape[1:]
+
+    if args.get('fnames_hp') is not None:
+        # the movie was mean-subtracted and high-passed once by globalModels.saveHighpassed
+        data_hp = np.reshape(data, (data.shape[0], -1))
+        meanIM, lowpass, frames = loadHighpassedCrop(args['fnames_hp'], Xinds, Yinds, roiShape)
+        data_lp = None
+        if highPassRegression:
+            data_pred = highpassVideo(data_hp.T, 1 / tau_pred, sampleRate, nThreads=hpThreads, backend=hpBackend).T
+        else:
+            data_pred = data_hp
+    else:
+        meanIM = np.mean(data, axis=0)
+        data = np.reshape(data, (data.shape[0], -1))
+        data = data - np.mean(data, 0)
+        data = data - np.mean(data, 0)
+
+        # remove low frequency components
+        data_hp = highpassVideo(data.T, 1 / tau_lp, sampleRate, nThreads=hpThreads, backend=hpBackend).T
+        data_lp = data - data_hp
+        if highPassRegression:
+            data_pred = highpassVideo(data.T, 1 / tau_pred, sampleRate, nThreads=hpThreads, backend=hpBackend).T
+        else:
+            data_pred = data_hp
+    del data
+
+    selectPred = np.ones(data_hp.shape[0])
+    if highPassRegression:
+        selectPred[:np.int16(sampleRate / 2 + 1)] = 0
+        selectPred[-1 - np.int16(sampleRate / 2):] = 0
+    rows = slice(None) if np.all(selectPred > 0) else (selectPred > 0)
+
+    # background components of the group, censoring all its ROIs
+    if args.get('bgModel') is None:
+        censored = np.zeros(shape, dtype=bool)
+        for _, bw, _ in cells:
+            censored |= dilation(bw[Xinds[0]:Xinds[-1] + 1, Yinds[0]:Yinds[-1] + 1], disk(censorSize)) > 0
+        Ub, Sb, Vb = svds(data_hp[:, ~censored.ravel()], nPC_bg)
+    else:
+        bgModel = np.load(args['bgModel'])
+
+    # Gram matrix of the predictor shared by the group, for the primal form of the regression
+    gram = None
+    if len(cells) > 1 and data_pred.shape[1] <= data_pred.shape[0]:
+        gram = np.matmul(data_pred[rows].T, data_pred[rows])
+        mean = np.mean(data_pred[rows], axis=0)
+        gram -= data_pred[rows].shape[0] * np.outer(mean, mean)
+
+    outputs = []
+    for (cellN, bw, weights_init), (cX, cY) in zip(cells, windows):
+        print('Now processing cell number {0}'.format(cellN))
+        # pixels of the context window of the cell within the union
+        window = (slice(cX[0] - Xinds[0], cX[-1] + 1 - Xinds[0]), slice(cY[0] - Yinds[0], cY[-1] + 1 - Yinds[0]))
+        if len(cells) == 1:
+            cell_hp, cell_pred, cell_gram = data_hp, data_pred, gram
+        else:
+            pixels = np.reshape(np.arange(np.prod(shape)), shape)[window].ravel()
+            cell_hp = data_hp[:, pixels]
+            cell_pred = data_pred[:, pixels] if highPassRegression else cell_hp
+            cell_gram = None if gram is None else gram[np.ix_(pixels, pixels)]
+
+        bw = bw[cX[0]:cX[-1] + 1, cY[0]:cY[-1] + 1]
+        notbw = 1 - dilation(bw, disk(censorSize))
+        bw = (bw > 0)
+        notbw = (notbw > 0)
+        if args.get('bgModel') is not None:
+            Ub = sliceBackgroundPCs(bgModel, cX, cY, notbw, nPC_bg)
+
+        # baseline fluorescence of the ROI
+        inROI = np.zeros(shape, dtype=bool)
+        inROI[window] = bw
+        if data_lp is None:
+            F0 = np.interp(np.arange(data_hp.shape[0]), frames, np.nanmean(lowpass[:, inROI], 1))
+            F0 = F0 + np.nanmean(meanIM[inROI])
+        else:
+            F0 = np.nanmean(data_lp[:, inROI.ravel()] + meanIM[inROI][np.newaxis, :], 1)
+
+        output = spikePursuitCell(cellN, cell_hp, F0, cell_pred, meanIM[window], bw, notbw, Ub,
+                                  weights_init, cell_gram, rows, sampleRate, args)
+        output['ROI'] = np.transpose(np.vstack((cX[[0, -1]], cY[[0, -1]])))
+        if args.get('outputFields') is not None:
+            output = {key: output[key] for key in ['cellN'] + [k for k in args['outputFields'] if k != 'cellN']}
+        outputs.append(output)
+    releaseSharedArrays()
+
+    # the outputs are written to the results file here rather than pickled back to VOLPY.fit
+    if args.get('resultsFolder') is not None:
+        store = EstimatesStore(movieFolder(args['resultsFolder'], fnames))
+        for output in outputs:
+            store.write(output, args.get('keys', {}).get(output['cellN']))
+        outputs = [{'cellN': output['cellN'], 'stored': True} for output in outputs]
+
+    return outputs
+
+
+def spikePursuitCell(cellN, data_hp, F0, data_pred, meanIM, bw, notbw, Ub, weights_init, gram, rows,
+                     sampleRate, args):
+    """ Function for alternating ridge regression of the spatial filter and spike detection
+        of one neuron, given its preprocessed context window.
+
+        Args:
+            cellN: int
+                number of cell processing
+
+            data_hp, data_pred: 2-D arrays
+                high-passed movie and predictor of the regression, frames x pixels
+
+            F0: 1-D array
+                baseline fluorescence of the ROI
+
+            meanIM: 2-D array
+                mean image of the context window
+
+            bw, notbw: 2-D boolean arrays
+                ROI and background of the context window
+
+            Ub: 2-D array
+                background components, frames x nPC_bg
+
+            weights_init: 2-d array, 1-d array or None
+                spatial filter or spatial weights of a previous data block, as in volspike
+
+            gram: 2-D array or None
+                centered Gram matrix of data_pred[rows] computed beforehand
+
+            rows: slice or 1-D boolean array
+                frames used in the regression
+
+            sampleRate: int
+
+            args: dictionary
+                same as in volspike
+
+        Returns:
+            output: a dictionary
+                as returned by volspike
+    """
+    doCrossVal = args['doCrossVal']
+    doGlobalSubtract = args['doGlobalSubtract']
     sigmas = args['sigmas']
     nIter = args['nIter']
     localAlign = args['localAlign']
     globalAlign = args['globalAlign']
-    highPassRegression = args['highPassRegression']
+    hpBackend = args.get('hpBackend', 'iir')
     windowLength = sampleRate * 0.02 # window length for spike templates
     output = {}
     output['rawROI'] = {}
+    output['meanIM'] = meanIM
+    shape = bw.shape
+    if args.get('diagnostics'):
+        # arrays of the figures, drawn afterwards by report.renderReport
+        output['diagnostics'] = {}
 
-    Yr, dims, T = cm.load_memmap(fnames)
-    if bw.shape == dims:
-        images = np.reshape(Yr.T, [T] + list(dims), order='F')
-    elif bw.shape == dims[::-1]:
-        images = np.reshape(Yr.T, [T] + list(dims), order='F').transpose([0, 2, 1])
+    # initial trace
+    if weights_init is not None and np.ndim(weights_init) == 2:
+        # spatial filter of a previous block, whatever sigma it was blurred with
+        warmStart = np.shape(weights_init) == shape
+        initFilter = np.ravel(weights_init) if warmStart else None
     else:
-        print('size of ROI and video does not accrod')
-
-    # extract relevant region and align
-    bwexp = dilation(bw, np.ones([contextSize, contextSize]), shift_x=True, shift_y=True)
-    Xinds = np.where(np.any(bwexp > 0, axis=1) > 0)[0]
-    Yinds = np.where(np.any(bwexp > 0, axis=0) > 0)[0]
-    bw = bw[Xinds[0]:Xinds[-1] + 1, Yinds[0]:Yinds[-1] + 1]
-    notbw = 1 - dilation(bw, disk(censorSize))
-    data = np.array(images[:, Xinds[0]:Xinds[-1] + 1, Yinds[0]:Yinds[-1] + 1])
-    bw = (bw > 0)
-    notbw = (notbw > 0)
-    ref = np.median(data[:500, :, :], axis=0)
-
-    # visualize ROI
-    # fig = plt.figure()
-    # plt.subplot(131);plt.imshow(ref);plt.axis('image');plt.xlabel('mean Intensity')
-    # plt.subplot(132);plt.imshow(bw);plt.axis('image');plt.xlabel('initial ROI')
-    # plt.subplot(133);plt.imshow(notbw);plt.axis('image');plt.xlabel('background')
-    # fig.suptitle('ROI selection')
-    # plt.show()
-
-    output['meanIM'] = np.mean(data, axis=0)
-    data = np.reshape(data, (data.shape[0], -1))
-    data = data - np.mean(data, 0)
-    data = data - np.mean(data, 0)
-
-    # remove low frequency components
-    data_hp = highpassVideo(data.T, 1 / tau_lp, sampleRate).T
-    data_lp = data - data_hp
-    data_pred = np.empty_like(data_hp)
-    if highPassRegression:
-        data_pred[:] = highpassVideo(data, 1 / tau_pred, sampleRate)
+        # regression weights of a previous block, blurred with the default sigma
+        warmStart = weights_init is not None and len(weights_init) == data_hp.shape[1] + 1
+        initFilter = gaussianBlurMatrix(shape, sigmas[1]).T.dot(weights_init[1:]) if warmStart else None
+    if weights_init is not None and not warmStart:
+        print('Spatial weights do not match the context of cell {0}, starting from the ROI'.format(cellN))
+    if warmStart:
+        # trace of the spatial filter found on a previous block; it needs fewer iterations
+        t = -np.matmul(data_hp, initFilter)  # weights are negative
+        nIter = args['nIterWarm']
     else:
-        data_pred[:] = data_hp
-
-    # initial trace
-    if weights_init is None:
         t = np.nanmean(data_hp[:, bw.ravel()], 1)
-    else:
-        t = -np.matmul(data_hp, weights_init[1:])    # weights are negative 
     t = t - np.mean(t)
 
     # remove any variance in trace that can be predicted from the background principal components
-    Ub, Sb, Vb = svds(data_hp[:, notbw.ravel()], nPC_bg)
     reg = LinearRegression(fit_intercept=False).fit(Ub, t)
     t = np.double(t - np.matmul(Ub, reg.coef_))
 
     # find out spikes of initial trace
-    Xspikes, spikeTimes, guessData, output['rawROI']['falsePosRate'], output['rawROI']['detectionRate'], \
-    output['rawROI']['templates'], low_spk = denoiseSpikes(-t, windowLength, sampleRate, False, 100)
-
-    Xspikes = -Xspikes
-    output['rawROI']['X'] = t.copy()
-    output['rawROI']['Xspikes'] = Xspikes.copy()
-    output['rawROI']['spikeTimes'] = spikeTimes.copy()
-    output['rawROI']['spatialFilter'] = bw.copy()
-    output['rawROI']['X'] = output['rawROI']['X'] * np.mean(t[output['rawROI']['spikeTimes']]) / np.mean(
-        output['rawROI']['X'][output['rawROI']['spikeTimes']])  # correct shrinkage
+    if warmStart:
+        # the raw ROI pass is skipped
+        Xspikes, spikeTimes, guessData, _, _, templates, low_spk = denoiseSpikes(-t, windowLength, sampleRate,
+                                                                               False, 100, hpBackend,
+                                                                               sparseGuess=True)
+        Xspikes = -Xspikes
+    else:
+        Xspikes, spikeTimes, guessData, output['rawROI']['falsePosRate'], output['rawROI']['detectionRate'], \
+        output['rawROI']['templates'], low_spk = denoiseSpikes(-t, windowLength, sampleRate, False, 100,
+                                                               hpBackend, sparseGuess=True)
+
+        Xspikes = -Xspikes
+        output['rawROI']['X'] = t.copy()
+        output['rawROI']['Xspikes'] = Xspikes.copy()
+        output['rawROI']['spikeTimes'] = spikeTimes.copy()
+        output['rawROI']['spatialFilter'] = bw.copy()
+        output['rawROI']['X'] = output['rawROI']['X'] * np.mean(t[output['rawROI']['spikeTimes']]) / np.mean(
+            output['rawROI']['X'][output['rawROI']['spikeTimes']])  # correct shrinkage
+        templates = output['rawROI']['templates']
     output['num_spikes'] = [spikeTimes.shape[0]]
-    templates = output['rawROI']['templates']
     selectSpikes = np.zeros(Xspikes.shape)
     selectSpikes[spikeTimes] = 1
     sgn = np.mean(Xspikes[selectSpikes > 0])
     noise = np.std(Xspikes[selectSpikes == 0])
     snr = sgn / noise
 
-    # prebuild the regression matrix
-    # generate a predictor for ridge regression
-    pred = np.empty_like(data_pred)
-    pred[:] = data_pred
-    pred = np.hstack((np.ones((data_pred.shape[0], 1), dtype=np.single), np.reshape
-    (movie.gaussian_blur_2D(np.reshape(pred,
-                                       (data_hp.shape[0], ref.shape[0], ref.shape[1])),
-                            kernel_size_x=7, kernel_size_y=7, kernel_std_x=1.5,
-                            kernel_std_y=1.5, borderType=cv2.BORDER_REPLICATE), data_hp.shape)))
-
-    # Cross-validation of regularized regression parameters
-    lambdamax = np.single(np.linalg.norm(pred[:, 1:], ord='fro') ** 2)
+    # the predictor for ridge regression is the blurred movie, the blur is kept as a
+    # sparse linear operator and applied to pixel vectors instead of to every frame
+    lambdamax = np.single(np.sum(blurredColumnNorms(data_pred, gaussianBlurMatrix(shape, 1.5, 7)) ** 2))
     lambdas = lambdamax * np.logspace(-4, -2, 3)
-    I0 = np.eye(pred.shape[1], dtype=np.single)
-    I0[0, 0] = 0
 
+    # factorize the regression once, it is reused in every iteration
     if doCrossVal:
-        # need to add
         print('doing cross validation')
+        errors = crossValidateRidge(data_pred[rows], guessData[rows], lambdas,
+                                    [gaussianBlurMatrix(shape, sig) for sig in sigmas], gram=gram)
+        s_max, l_max = np.unravel_index(np.argmin(errors), errors.shape)
+        print('selected sigma {0} and lambda {1}'.format(sigmas[s_max], lambdas[l_max]))
     else:
         s_max = 1
         l_max = 2
-        lambd = lambdas[l_max]
-        sigma = sigmas[s_max]
-        lambda_ix = l_max
+    solver = RidgeSolver(data_pred[rows], lambdas[l_max], blur=gaussianBlurMatrix(shape, sigmas[s_max]), gram=gram)
+    blur = solver.blur
 
-    selectPred = np.ones(data_hp.shape[0])
-    if highPassRegression:
-        selectPred[:np.int16(sampleRate / 2 + 1)] = 0
-        selectPred[-1 - np.int16(sampleRate / 2):] = 0
-    sigma = sigmas[s_max]
-
-    pred = np.empty_like(data_pred)
-    pred[:] = data_pred
-    pred = np.hstack((np.ones((data_pred.shape[0], 1), dtype=np.single), np.reshape
-    (movie.gaussian_blur_2D(np.reshape(pred,
-                                       (data_pred.shape[0], ref.shape[0], ref.shape[1])),
-                            kernel_size_x=np.int(2 * np.ceil(2 * sigma) + 1),
-                            kernel_size_y=np.int(2 * np.ceil(2 * sigma) + 1),
-                            kernel_std_x=sigma, kernel_std_y=sigma,
-                            borderType=cv2.BORDER_REPLICATE), data_pred.shape)))
-
-    recon = np.empty_like(data_hp)
-    recon[:] = data_hp
-    recon = np.hstack((np.ones((data_hp.shape[0], 1), dtype=np.single), np.reshape
-    (movie.gaussian_blur_2D(np.reshape(recon,
-                                       (data_hp.shape[0], ref.shape[0], ref.shape[1])),
-                            kernel_size_x=np.int(2 * np.ceil(2 * sigma) + 1),
-                            kernel_size_y=np.int(2 * np.ceil(2 * sigma) + 1),
-                            kernel_std_x=sigma, kernel_std_y=sigma,
-                            borderType=cv2.BORDER_REPLICATE), data_hp.shape)))
-    
     # Identify spatial filters with regularized regression
+    prevSpikes = None
+    prevWeights = None
     for iteration in range(nIter):
-        doPlot = False
-        if iteration == nIter - 1:
-            doPlot = True
-
         # print('Identifying spatial filters')
         # print(iteration)
-     
-        Ri = Ridge(alpha=lambdas[l_max], fit_intercept=True, solver='lsqr')
-        gD = np.single(guessData[selectPred>0])
-        Ri.fit(recon, gD)
-        weights = Ri.coef_
-        weights[0] = Ri.intercept_
-
-        X = np.matmul(recon, weights)
+
+        # guessData is the sparse spike train convolved with the template
+        weights = solver.solve(guessData[rows])
+
+        # stop early once the spikes and the weights no longer change, this iteration is the last one
+        converged = hasConverged(prevSpikes, spikeTimes, prevWeights, weights, args.get('jaccardTol'),
+                                 args.get('weightTol'))
+        prevSpikes = spikeTimes
+        prevWeights = weights
+        last = converged or iteration == nIter - 1
+        diagnostics = output['diagnostics'] if (last and args.get('diagnostics')) else None
+
+        # blurred data times weights equals data times the blurred weights
+        X = np.matmul(data_hp, blur.T.dot(weights[1:])) + weights[0]
         X = X - np.mean(X)
 
-        spatialFilter = np.empty_like(weights)
-        spatialFilter[:] = weights
-        spatialFilter = movie.gaussian_blur_2D(np.reshape(spatialFilter[1:],
-                                                          ref.shape, order='C')[np.newaxis, :, :],
-                                               kernel_size_x=np.int(2 * np.ceil(2 * sigma) + 1),
-                                               kernel_size_y=np.int(2 * np.ceil(2 * sigma) + 1),
-                                               kernel_std_x=sigma, kernel_std_y=sigma,
-                                               borderType=cv2.BORDER_REPLICATE)[0]
+        spatialFilter = np.reshape(blur.dot(weights[1:]), shape, order='C')
 
-        if iteration < nIter - 1:
+        if not last:
             b = LinearRegression(fit_intercept=False).fit(Ub, X).coef_
-            if doPlot:
-                plt.figure()
-                plt.plot(X)
-                plt.plot(np.matmul(Ub, b))
-                plt.title('Denoised trace vs background')
-                plt.show()
             X = X - np.matmul(Ub, b)
         else:
             b = LinearRegression(fit_intercept=False).fit(Ub, X).coef_
+            if args.get('diagnostics'):
+                output['diagnostics']['trace'] = X.copy()
+                output['diagnostics']['background'] = np.matmul(Ub, b)
             X = X - np.matmul(Ub, b)
             if doGlobalSubtract:
-                print('do global subtract')
-            # need to add
+                # global signal estimated once per recording by VOLPY.fit
+                if args.get('globalSignal') is None:
+                    print('no global signal was provided, skipping global subtraction')
+                else:
+                    Ug = attachSharedArray(args['globalSignal'])
+                    b = LinearRegression(fit_intercept=False).fit(Ug, X).coef_
+                    X = X - np.matmul(Ug, b)
+                    del Ug
 
         # correct shrinkage
         X = np.double(X * np.mean(t[spikeTimes]) / np.mean(X[spikeTimes]))
@@ -284,7 +466,10 @@ def volspike(pars):
         # generate the new trace and the new denoised trace
         Xspikes, spikeTimes, guessData, falsePosRate, detectionRate, templates, _ = denoiseSpikes(-X,
                                                                                                   windowLength,
-                                                                                                  sampleRate, doPlot)
+                                                                                                  sampleRate, False,
+                                                                                                  hpBackend=hpBackend,
+                                                                                                  sparseGuess=True,
+                                                                                                  diagnostics=diagnostics)
 
         selectSpikes = np.zeros(Xspikes.shape)
         selectSpikes[spikeTimes] = 1
@@ -293,11 +478,18 @@ def volspike(pars):
         snr = sgn / noise
 
         output['num_spikes'].append(spikeTimes.shape[0])
+        if last:
+            break
+    output['nIterRun'] = iteration + 1
+    # iterations skipped by early stopping or a warm start would repeat the last one, so the spike
+    # counts are padded with it and every cell has max(nIter, nIterWarm) + 1 of them
+    nCounts = max(args['nIter'], args.get('nIterWarm', 0)) + 1
+    output['num_spikes'] += [output['num_spikes'][-1]] * (nCounts - len(output['num_spikes']))
 
         # ensure that the maximum of the spatial filter is within the ROI
-    matrix = np.matmul(np.transpose(pred[:, 1:]), -guessData)
-    sigmax = np.sqrt(np.sum(np.multiply(pred[:, 1:], pred[:, 1:]), axis=0))
-    sigmay = np.sqrt(np.dot(guessData, guessData))
+    matrix = blur.dot(-np.asarray(guessData.T.dot(data_pred)).ravel())
+    sigmax = blurredColumnNorms(data_pred, blur)
+    sigmay = np.sqrt(guessData.multiply(guessData).sum())
     IMcorr = matrix / sigmax / sigmay
     maxCorrInROI = np.max(IMcorr[bw.ravel()])
     if np.any(IMcorr[notbw.ravel()] > maxCorrInROI):
@@ -316,16 +508,19 @@ def volspike(pars):
     # output
     output['y'] = X
     output['yFilt'] = -Xspikes
-    output['ROI'] = np.transpose(np.vstack((Xinds[[0, -1]], Yinds[[0, -1]])))
     output['ROIbw'] = bw
     output['spatialFilter'] = spatialFilter
+    if args.get('diagnostics'):
+        output['diagnostics']['spatialFilter'] = spatialFilter
+        output['diagnostics']['cellN'] = cellN
     output['falsePosRate'] = falsePosRate
     output['detectionRate'] = detectionRate
     output['templates'] = templates
     output['spikeTimes'] = spikeTimes
-    output['F0'] = np.nanmean(data_lp[:, bw.flatten()] + output['meanIM'][bw][np.newaxis, :], 1)
+    output['F0'] = F0
     output['dFF'] = X / output['F0']
-    output['rawROI']['dFF'] = output['rawROI']['X'] / output['F0']
+    if not warmStart:
+        output['rawROI']['dFF'] = output['rawROI']['X'] / output['F0']
     output['bg_pc'] = Ub  # background components
     output['low_spk'] = low_spk
     output['weights'] = weights
@@ -334,7 +529,38 @@ def volspike(pars):
     return output
 
 
-def denoiseSpikes(data, windowLength, sampleRate=400, doPlot=True, doClip=150):
+def hasConverged(prevSpikes, spikeTimes, prevWeights, weights, jaccardTol=0, weightTol=0):
+    """ Convergence of the alternation between spatial and temporal filters: the spike set
+        whose template was regressed did not change, up to a Jaccard distance of jaccardTol,
+        from the previous iteration, and neither did the weights, up to a relative change of
+        weightTol. With both tolerances 0 the next iterations would repeat this one exactly.
+
+    Args:
+        prevSpikes, spikeTimes: 1-D arrays or None
+            spike sets regressed at the previous and at this iteration
+
+        prevWeights, weights: 1-D arrays or None
+            weights found at the previous and at this iteration
+
+        jaccardTol: float or None
+            tolerance on the Jaccard distance between the spike sets, None never stops early
+
+        weightTol: float or None
+            tolerance on the relative change of the weights, None never stops early
+
+    Returns:
+        converged: boolean
+    """
+    if jaccardTol is None or weightTol is None or prevSpikes is None or prevWeights is None:
+        return False
+    union = len(np.union1d(prevSpikes, spikeTimes))
+    jaccard = len(np.intersect1d(prevSpikes, spikeTimes)) / union if union else 1
+    change = np.linalg.norm(weights - prevWeights) / max(np.linalg.norm(prevWeights), np.finfo(float).tiny)
+    return jaccard >= 1 - jaccardTol and change <= weightTol
+
+
+def denoiseSpikes(data, windowLength, sampleRate=400, doPlot=True, doClip=150, hpBackend='iir', sparseGuess=False,
+                  diagnostics=None):
     """ Function for finding spikes and the temporal filter given one dimensional signals.
         Use function whitenedMatchedFilter to denoise spikes. Function getThresh
         helps to find the best threshold given height of spikes.
@@ -356,6 +582,16 @@ def denoiseSpikes(data, windowLength, sampleRate=400, doPlot=True, doClip=150):
         doClip: int, default:150
             maximum number of spikes accepted
 
+        hpBackend: str, 'iir' or 'fft', default:'iir'
+            backend of the 1 Hz high-pass filter, see highpassVideo
+
+        sparseGuess: boolean, default:False
+            if True, guessData is returned as a sparse column, see spikeTemplateVector
+
+        diagnostics: dict or None
+            if given, the arrays of the plots are stored in it instead of being plotted,
+            see report.renderReport
+
     Returns:
         datafilt: 1-D array
             signals after whitened matched filter
@@ -363,7 +599,7 @@ def denoiseSpikes(data, windowLength, sampleRate=400, doPlot=True, doClip=150):
         spikeTimes: 1-D array
             record of time of spikes
 
-        guessData: 1-D array
+        guessData: 1-D array or sparse matrix
             recovery of original signals
 
         falsePosRate: float
@@ -380,8 +616,11 @@ def denoiseSpikes(data, windowLength, sampleRate=400, doPlot=True, doClip=150):
     """
 
     # highpass filter and threshold
-    bb, aa = signal.butter(1, 1 / (sampleRate / 2), 'high')  # 1Hz filter
-    dataHP = signal.filtfilt(bb, aa, data, padtype='odd', padlen=3 * (max(len(bb), len(aa)) - 1)).flatten()
+    if hpBackend == 'fft':
+        dataHP = fftHighpass(data, 1 / (sampleRate / 2), order=1).flatten()  # 1Hz filter
+    else:
+        bb, aa = signal.butter(1, 1 / (sampleRate / 2), 'high')  # 1Hz filter
+        dataHP = signal.filtfilt(bb, aa, data, padtype='odd', padlen=3 * (max(len(bb), len(aa)) - 1)).flatten()
 
     pks = dataHP[signal.find_peaks(dataHP, height=None)[0]]
 
@@ -405,9 +644,9 @@ def denoiseSpikes(data, windowLength, sampleRate=400, doPlot=True, doClip=150):
     thresh2, falsePosRate, detectionRate, _ = getThresh(pks2, doClip=0, pnorm=0.5)  # doClip=0 means no clipping
     spikeTimes = signal.find_peaks(datafilt, height=thresh2)[0]
 
-    guessData = np.zeros(data.shape)
-    guessData[spikeTimes] = 1
-    guessData = np.convolve(guessData, PTA, 'same')
+    guessData = spikeTemplateVector(spikeTimes, PTA, len(data))
+    if not sparseGuess:
+        guessData = guessData.toarray().ravel()
 
     # filtering shrinks the data;
     # rescale so that the mean value at the peaks is same as in the input
@@ -416,6 +655,10 @@ def denoiseSpikes(data, windowLength, sampleRate=400, doPlot=True, doClip=150):
     # output templates
     templates = PTA
 
+    if diagnostics is not None:
+        diagnostics.update({'pks': pks, 'thresh': thresh, 'pks2': pks2, 'thresh2': thresh2, 'PTD': PTD, 'PTA': PTA,
+                            'data': data, 'datafilt': datafilt, 'locs': locs, 'spikeTimes': spikeTimes})
+
     # plot three graphs
     if doPlot:
         plt.figure()
@@ -454,6 +697,146 @@ def denoiseSpikes(data, windowLength, sampleRate=400, doPlot=True, doClip=150):
     return datafilt, spikeTimes, guessData, falsePosRate, detectionRate, templates, low_spk
 
 
+def denoiseSpikesBatch(data, windowLength, sampleRate=400, doClip=150, hpBackend='iir'):
+    """ Function for finding spikes and the temporal filters of many one dimensional signals
+        at once, e.g. the traces of all cells of a session. Same as denoiseSpikes without the
+        plots: the high-pass filter, the PSD of the noise, the whitening, the peak-triggered
+        averages and the matched filters run on all signals together, only the peak
+        detection and the thresholds are computed signal by signal.
+
+    Args:
+        data: 2-D array
+            signals x frames
+
+        windowLength: int
+            length of window size for temporal filter
+
+        sampleRate: int, default 400
+            number of samples per second in the video
+
+        doClip: int, default:150
+            maximum number of spikes accepted
+
+        hpBackend: str, 'iir' or 'fft', default:'iir'
+            backend of the 1 Hz high-pass filter, see highpassVideo
+
+    Returns:
+        datafilt: 2-D array
+            signals after whitened matched filter
+
+        spikeTimes: list of 1-D arrays
+            record of time of spikes of every signal
+
+        guessData: 2-D array
+            recovery of original signals
+
+        falsePosRate: 1-D array
+            possibility of misclassify noise as real spikes
+
+        detectionRate: 1-D array
+            possibility of real spikes being detected
+
+        templates: 2-D array
+            temporal filters which are the peak triggered averages
+
+        low_spk: 1-D boolean array
+            true if number of spikes is smaller than 30
+    """
+    data = np.atleast_2d(np.asarray(data, dtype=np.double))
+    nSignals, T = data.shape
+    window = np.int64(np.arange(-windowLength, windowLength + 1, 1))
+
+    # highpass filter and threshold
+    if hpBackend == 'fft':
+        dataHP = fftHighpass(data, 1 / (sampleRate / 2), order=1)  # 1Hz filter
+    else:
+        bb, aa = signal.butter(1, 1 / (sampleRate / 2), 'high')  # 1Hz filter
+        dataHP = signal.filtfilt(bb, aa, data, axis=-1, padtype='odd', padlen=3 * (max(len(bb), len(aa)) - 1))
+
+    low_spk = np.zeros(nSignals, dtype=bool)
+    isLoc = np.zeros(data.shape, dtype=bool)
+    for n in range(nSignals):
+        pks = dataHP[n, signal.find_peaks(dataHP[n], height=None)[0]]
+        thresh, _, _, low_spk[n] = getThresh(pks, doClip, 0.25)
+        locs = signal.find_peaks(dataHP[n], height=thresh)[0]
+        isLoc[n, locs[np.logical_and(locs > (-window[0]), locs < (T - window[-1]))]] = True
+
+    # peak-triggered averages
+    PTA = peakTriggeredAverage(data, isLoc, window)
+
+    # matched filters
+    datafilt = whitenedMatchedFilterBatch(data, isLoc, window)
+
+    # spikes detected after filter
+    falsePosRate = np.zeros(nSignals)
+    detectionRate = np.zeros(nSignals)
+    isSpike = np.zeros(data.shape)
+    spikeTimes = []
+    for n in range(nSignals):
+        pks2 = datafilt[n, signal.find_peaks(datafilt[n], height=None)[0]]
+        thresh2, falsePosRate[n], detectionRate[n], _ = getThresh(pks2, doClip=0, pnorm=0.5)
+        spikeTimes.append(signal.find_peaks(datafilt[n], height=thresh2)[0])
+        isSpike[n, spikeTimes[n]] = 1
+    guessData = lagSum(isSpike, PTA, -window)
+
+    # filtering shrinks the data;
+    # rescale so that the mean value at the peaks is same as in the input
+    for n in range(nSignals):
+        datafilt[n] *= np.mean(data[n, spikeTimes[n]]) / np.mean(datafilt[n, spikeTimes[n]])
+
+    return datafilt, spikeTimes, guessData, falsePosRate, detectionRate, PTA, low_spk
+
+
+def spikeTemplateVector(spikeTimes, template, T):
+    """ The spike train convolved with the template ('same' mode), kept as a sparse
+        frames x 1 column which only stores the frames around the spikes
+
+    Args:
+        spikeTimes: 1-D array
+            frames of the spikes
+
+        template: 1-D array
+            temporal template of odd length, centered on the spike
+
+        T: int
+            number of frames
+
+    Returns:
+        guessData: sparse matrix
+            T x 1 column, overlapping templates are summed
+    """
+    half = (len(template) - 1) // 2
+    frames = (np.asarray(spikeTimes)[:, np.newaxis] + np.arange(len(template)) - half).ravel()
+    values = np.tile(template, len(spikeTimes))
+    keep = np.logical_and(frames >= 0, frames < T)
+    return sparse.csr_matrix((values[keep], (frames[keep], np.zeros(np.sum(keep), dtype=int))), shape=(T, 1))
+
+
+def lagSum(data, kernels, lags):
+    """ Sum over i of kernels[:, i] times data shifted by lags[i], i.e. out[:, t] is the sum
+        of kernels[:, i] * data[:, t + lags[i]], data being zero outside of its frames
+    """
+    nSignals, T = data.shape
+    pad = int(np.max(np.abs(lags)))
+    padded = np.zeros((nSignals, T + 2 * pad))
+    padded[:, pad:pad + T] = data
+    out = np.zeros((nSignals, T))
+    for i, lag in enumerate(lags):
+        out += kernels[:, i, np.newaxis] * padded[:, pad + lag:pad + lag + T]
+    return out
+
+
+def peakTriggeredAverage(data, isLoc, window):
+    """ Average of every signal over the windows around its peaks isLoc
+    """
+    nLocs = np.sum(isLoc, axis=1)
+    PTA = np.zeros((data.shape[0], len(window)))
+    for i, lag in enumerate(window):
+        # the peaks are at least len(window) frames away from the ends
+        PTA[:, i] = np.sum(np.roll(data, -lag, axis=1) * isLoc, axis=1)
+    return PTA / nLocs[:, np.newaxis]
+
+
 def getThresh(pks, doClip, pnorm=0.5):
     """ Function for deciding threshold given heights of all peaks.
 
@@ -484,8 +867,7 @@ def getThresh(pks, doClip, pnorm=0.5):
     spread = spread + np.diff(spread) * np.array([-0.05, 0.05])
     low_spk = False
     pts = np.linspace(spread[0], spread[1], 2001)
-    kde = stats.gaussian_kde(pks)
-    f = kde(pts)    
+    f = binnedKDE(pks, pts)
     xi = pts
     center = np.where(xi > np.median(pks))[0][0]
 
@@ -530,48 +912,497 @@ def getThresh(pks, doClip, pnorm=0.5):
     return thresh, falsePosRate, detectionRate, low_spk
 
 
+def binnedKDE(samples, pts, truncate=6):
+    """
+    Gaussian kernel density estimate with Scott's bandwidth, as scipy.stats.gaussian_kde,
+    evaluated on the evenly spaced points pts. The samples are linearly binned onto the
+    points and the bins are convolved with the kernel by FFT, so the cost does not grow
+    with the product of the number of samples and of points.
+
+    Args:
+        samples: 1-D array
+            samples of the distribution, within the range of pts
+
+        pts: 1-D array
+            evenly spaced points where the density is evaluated
+
+        truncate: float
+            the kernel is truncated at this many bandwidths
+
+    Returns:
+        density: 1-D array
+            density at pts
+    """
+    samples = np.asarray(samples, dtype=np.double)
+    n = len(samples)
+    h = np.std(samples, ddof=1) * n ** (-1 / 5)
+    dx = pts[1] - pts[0]
+
+    # linear binning
+    pos = np.clip((samples - pts[0]) / dx, 0, len(pts) - 1)
+    left = np.minimum(np.floor(pos).astype(int), len(pts) - 2)
+    frac = pos - left
+    counts = np.bincount(left, weights=1 - frac, minlength=len(pts)) + \
+             np.bincount(left + 1, weights=frac, minlength=len(pts))
+
+    M = int(min(np.ceil(truncate * h / dx), len(pts) - 1))
+    kernel = np.exp(-0.5 * (np.arange(-M, M + 1) * dx / h) ** 2) / (np.sqrt(2 * np.pi) * h * n)
+    return signal.fftconvolve(counts, kernel, mode='same')
+
+
 def whitenedMatchedFilter(data, locs, window):
     """
     Function for using whitened matched filter to the original signal for better
     SNR. Use welch method to approximate the spectral density of the signal.
     Rescale the signal in frequency domain.
     """
-    N = np.ceil(np.log2(len(data)))
+    N = int(np.ceil(np.log2(len(data))))
     censor = np.zeros(len(data))
     censor[locs] = 1
     censor = np.int16(np.convolve(censor.flatten(), np.ones([1, len(window)]).flatten(), 'same'))
     censor = (censor < 0.5)
     noise = data[censor]
 
-    _, pxx = signal.welch(noise, fs=2 * np.pi, window=signal.get_window('hamming', 1000), nfft=2 ** N, detrend=False,
+    # the segments are zero-padded to about twice their length instead of to 2 ** N, and
+    # the PSD is carried over to the frequencies of the transform of the whole signal
+    nfft = min(2 ** N, welchLength(1000))
+    _, pxx = signal.welch(noise, fs=2 * np.pi, window=signal.get_window('hamming', 1000), nfft=nfft, detrend=False,
                           nperseg=1000)
-    Nf2 = np.concatenate([pxx, np.flipud(pxx[1:-1])])
-    scaling = 1 / np.sqrt(Nf2)
+    scaling = 1 / np.sqrt(refineWelch(pxx, 1000, nfft, 2 ** N))
 
-    # Use pyfftw for fast fourier transform
-    a = pyfftw.empty_aligned(data.shape[0], dtype='float64')
-    a[:] = data
-    dataScaled = np.real(pyfftw.interfaces.scipy_fftpack.ifft(pyfftw.interfaces.scipy_fftpack.fft(a, 2 ** N) * scaling))
+    # real FFTs through the plans of this process, shared by all the calls
+    dataScaled = irfft(rfft(data, 2 ** N) * scaling, 2 ** N)
     PTDscaled = dataScaled[(locs[:, np.newaxis] + window)]
     PTAscaled = np.mean(PTDscaled, 0)
-    datafilt = np.convolve(dataScaled, np.flipud(PTAscaled), 'same')
+    datafilt = signal.oaconvolve(dataScaled, np.flipud(PTAscaled), 'same')
     datafilt = datafilt[:len(data)]
     return datafilt
 
 
-def highpassVideo(video, freq, sampleRate):
+def welchLength(nperseg):
+    """
+    Function for finding the shortest power of two to which the Welch segments of length
+    nperseg are zero-padded so that refineWelch is exact, i.e. at least 2 * nperseg - 1
+    """
+    return 2 ** int(np.ceil(np.log2(2 * nperseg - 1)))
+
+
+def refineWelch(pxx, nperseg, nfft, n):
+    """
+    Function for carrying a one-sided Welch PSD computed with segments of length nperseg
+    zero-padded to nfft over to the rfft frequencies of length n. It equals the PSD computed
+    with the segments zero-padded to n: the averaged periodogram is the transform of the
+    averaged autocorrelation of the windowed segments, which has only 2 * nperseg - 1 lags,
+    all recovered from the transform of length nfft >= 2 * nperseg - 1.
     """
-    Function for passing signals with frequency higher than freq
+    p = np.array(pxx, dtype=np.double)
+    if nfft == n:
+        return p
+    p[..., 1:(nfft + 1) // 2] /= 2    # two-sided
+    r = np.fft.irfft(p, nfft)
+    lags = np.zeros(p.shape[:-1] + (n,))
+    lags[..., :nperseg] = r[..., :nperseg]
+    lags[..., n - nperseg + 1:] = r[..., nfft - nperseg + 1:]
+    P = np.fft.rfft(lags).real
+    P[..., 1:(n + 1) // 2] *= 2    # one-sided
+    return P
+
+
+def whitenedMatchedFilterBatch(data, isLoc, window, nperseg=1000):
+    """
+    Same as whitenedMatchedFilter for many signals at once. The Welch segments of the
+    noise of all signals are transformed together, and every signal is whitened and
+    filtered with the average of its whitened peaks.
+
+    Args:
+        data: 2-D array
+            signals x frames
+
+        isLoc: 2-D boolean array
+            peaks of every signal
+
+        window: 1-D array
+            offsets of the window around the peaks
+
+        nperseg: int
+            length of the Welch segments
+
+    Returns:
+        datafilt: 2-D array
+            signals after whitened matched filter
     """
+    nSignals, T = data.shape
+    N = int(np.ceil(np.log2(T)))
+    nfft = min(2 ** N, welchLength(nperseg))
+    censor = lagSum(isLoc.astype(np.double), np.ones((nSignals, len(window))), window)
+    censor = (censor < 0.5)
+
+    # Welch PSD of the noise of every signal, segments zero-padded to nfft
+    taper = signal.get_window('hamming', nperseg)
+    segments, owner = [], []
+    pxx = np.zeros((nSignals, nfft // 2 + 1))
+    for n in range(nSignals):
+        noise = data[n, censor[n]]
+        if len(noise) < nperseg:
+            _, pxx[n] = signal.welch(noise, fs=2 * np.pi, window=signal.get_window('hamming', nperseg), nfft=nfft,
+                                     detrend=False, nperseg=nperseg)
+            continue
+        starts = np.arange(0, len(noise) - nperseg + 1, nperseg // 2)
+        segments.append(noise[starts[:, np.newaxis] + np.arange(nperseg)])
+        owner.append(np.full(len(starts), n))
+    if segments:
+        owner = np.concatenate(owner)
+        power = np.abs(rfft(np.concatenate(segments) * taper, nfft)) ** 2 / (2 * np.pi * np.sum(taper ** 2))
+        power[:, 1:(nfft + 1) // 2] *= 2
+        counts = np.bincount(owner, minlength=nSignals)
+        total = np.zeros(pxx.shape)
+        np.add.at(total, owner, power)
+        pxx[counts > 0] = total[counts > 0] / counts[counts > 0, np.newaxis]
+
+    # whiten all signals together
+    scaling = 1 / np.sqrt(refineWelch(pxx, nperseg, nfft, 2 ** N))
+    dataScaled = irfft(rfft(data, 2 ** N) * scaling, 2 ** N)
+
+    # filter every signal with the average of its whitened peaks
+    isLocScaled = np.zeros(dataScaled.shape, dtype=bool)
+    isLocScaled[:, :T] = isLoc
+    PTAscaled = peakTriggeredAverage(dataScaled, isLocScaled, window)
+    return lagSum(dataScaled, PTAscaled, window)[:, :T]
+
+
+def highpassVideo(video, freq, sampleRate, blockSize=256, nThreads=1, backend='iir'):
+    """
+    Function for passing signals with frequency higher than freq. The zero-phase
+    Butterworth filter runs on blocks of pixels, each block copied to a contiguous
+    buffer, and the blocks are split across threads. Only the float32 output and one
+    small buffer per thread are held in memory.
+
+    Args:
+        video: 2-D array
+            pixels x frames
+
+        freq: float
+            cutoff frequency
+
+        sampleRate: int
+
+        blockSize: int
+            number of pixels filtered at once by a thread
+
+        nThreads: int
+            number of threads; None uses all the cores, which oversubscribes the machine when
+            many worker processes filter at the same time
+
+        backend: str, 'iir' or 'fft'
+            'iir' filters forward and backward in second-order sections, 'fft' applies the
+            same magnitude response in the frequency domain (see fftHighpass), which is
+            faster for long recordings
+
+    Returns:
+        videoFilt: 2-D array
+            float32, pixels x frames
+    """
+    if backend not in ('iir', 'fft'):
+        raise ValueError('Unknown high-pass backend {0}'.format(backend))
     normFreq = freq / (sampleRate / 2)
-    b, a = signal.butter(3, normFreq, 'high')
-    videoFilt = np.single(signal.filtfilt(b, a, video, padtype='odd', padlen=3 * (max(len(b), len(a)) - 1)))
+    sos = signal.butter(3, normFreq, 'high', output='sos')
+    if video.ndim == 1:
+        return highpassVideo(video[np.newaxis], freq, sampleRate, blockSize, nThreads, backend)[0]
+    videoFilt = np.empty(video.shape, dtype=np.single)
+
+    def filterBlock(i):
+        # the recursion runs in double precision; the block is small, the output is single
+        block = np.ascontiguousarray(video[i:i + blockSize], dtype=np.double)
+        if backend == 'fft':
+            videoFilt[i:i + blockSize] = fftHighpass(block, normFreq, order=3)
+        else:
+            videoFilt[i:i + blockSize] = signal.sosfiltfilt(sos, block, padtype='odd', padlen=9)
+
+    starts = range(0, video.shape[0], blockSize)
+    if nThreads is None:
+        nThreads = os.cpu_count() or 1
+    if nThreads > 1 and len(starts) > 1:
+        with ThreadPoolExecutor(min(nThreads, len(starts))) as executor:
+            list(executor.map(filterBlock, starts))
+    else:
+        for i in starts:
+            filterBlock(i)
     return videoFilt
 
 
+def fftHighpass(data, normFreq, order=3, padlen=None):
+    """
+    Zero-phase Butterworth high-pass in the frequency domain. The squared magnitude
+    response of the digital filter, which is the response of filtering forward and
+    backward, multiplies one real FFT of all the time series at once. The series are
+    extended by odd reflection, as filtfilt does, over about one period of the cutoff
+    so that the circular convolution does not wrap around the ends.
+
+    Args:
+        data: 1-D or 2-D array
+            time series along the last axis
+
+        normFreq: float
+            cutoff frequency normalized by the Nyquist frequency
+
+        order: int
+            order of the Butterworth filter
+
+        padlen: int
+            length of the odd extension at each end, by default 2 / normFreq
+
+    Returns:
+        dataFilt: array
+            filtered time series, same shape as data
+    """
+    T = data.shape[-1]
+    if padlen is None:
+        padlen = int(np.ceil(2 / normFreq))
+    padlen = min(padlen, T - 1)
+    ext = np.concatenate([2 * data[..., :1] - data[..., padlen:0:-1], data,
+                          2 * data[..., -1:] - data[..., -2:-padlen - 2:-1]], axis=-1)
+    n = fft.next_fast_len(ext.shape[-1], real=True)
+    sos = signal.butter(order, normFreq, 'high', output='sos')
+    _, h = signal.sosfreqz(sos, worN=2 * np.pi * np.arange(n // 2 + 1) / n)
+    dataFilt = irfft(rfft(ext, n) * np.abs(h) ** 2, n)
+    return dataFilt[..., padlen:padlen + T]
+
+
+def contextWindow(bw, contextSize):
+    """
+    Function for finding the rows and columns of the context window surrounding the ROI bw
+    """
+    bwexp = dilation(bw, np.ones([contextSize, contextSize]), shift_x=True, shift_y=True)
+    Xinds = np.where(np.any(bwexp > 0, axis=1) > 0)[0]
+    Yinds = np.where(np.any(bwexp > 0, axis=0) > 0)[0]
+    return Xinds, Yinds
+
+
+def sliceBackgroundPCs(bgModel, Xinds, Yinds, notbw, nPC_bg):
+    """
+    Function for getting the background components of one cell from the global background
+    model, restricted to the censored background of its crop
+    """
+    V = bgModel['V'][Xinds[0]:Xinds[-1] + 1, Yinds[0]:Yinds[-1] + 1][notbw]
+    Q = np.linalg.svd(bgModel['S'][:, np.newaxis] * V.T, full_matrices=False)[0]
+    return np.matmul(bgModel['U'], Q[:, :nPC_bg])
+
+
+def gaussianBlurMatrix(shape, sigma, ksize=None):
+    """
+    Function for building the Gaussian blur of an image as a sparse matrix acting on
+    the image flattened in C order. Same kernel and replicated border as cv2.GaussianBlur
+    """
+    if ksize is None:
+        ksize = int(2 * np.ceil(2 * sigma) + 1)
+    r = ksize // 2
+    kernel = np.exp(-np.arange(-r, r + 1) ** 2 / (2 * sigma ** 2))
+    kernel = kernel / np.sum(kernel)
+
+    blur1d = []
+    for n in shape:
+        rows = np.repeat(np.arange(n), ksize)
+        cols = np.clip(rows + np.tile(np.arange(-r, r + 1), n), 0, n - 1)    # replicate border
+        blur1d.append(sparse.csr_matrix((np.tile(kernel, n), (rows, cols)), shape=(n, n)))
+    return sparse.kron(blur1d[0], blur1d[1], format='csr').astype(np.single)
+
+
+def blurredColumnNorms(data, blur, blockSize=1000):
+    """
+    Function for computing the norm of every column of the blurred movie data @ blur.T
+    without building it, processing blocks of frames
+    """
+    sumSquares = np.zeros(data.shape[1])
+    for i in range(0, data.shape[0], blockSize):
+        sumSquares += np.sum(blur.dot(data[i:i + blockSize].T) ** 2, axis=1)
+    return np.sqrt(sumSquares)
+
+
+class RidgeSolver(object):
+    """ Ridge regression with an unpenalized intercept for finding spatial filters.
+        The regularized normal equations are solved with a Cholesky factorization
+        which is computed once and reused for every new target, either in the primal
+        form (pixels x pixels) or in the dual form (frames x frames), whichever is
+        smaller. The predictor is data @ blur.T, where the spatial blur is a sparse
+        operator; it is centered implicitly, so neither the blurred movie nor a
+        centered copy of it nor an explicit inverse is ever built. With an
+        eigendecomposition instead of the Cholesky factorization, the regularization
+        parameter can be changed for free, which is used for cross validation.
+    """
+    def __init__(self, pred, lambd, blur=None, form='auto', blockSize=1000, factorization='cholesky', gram=None):
+        """
+            pred: 2-D array
+                data of the predictor, frames x pixels
+
+            lambd: float
+                regularization parameter
+
+            blur: sparse matrix or None
+                spatial blur applied to every frame of pred, pixels x pixels
+
+            form: str, 'auto', 'primal' or 'dual'
+                which form of the normal equations to factorize; 'auto' picks the smaller one
+
+            blockSize: int
+                number of frames processed at once when building the dual form
+
+            factorization: str, 'cholesky' or 'eigh'
+                factorization of the normal equations; 'eigh' allows changing self.lambd afterwards
+                or solving for several lambdas
+
+            gram: 2-D array or None
+                centered pred' @ pred computed beforehand, e.g. shared by a group of cells;
+                implies the primal form
+        """
+        T, P = pred.shape
+        if gram is not None:
+            form = 'primal'
+        if form == 'auto':
+            form = 'primal' if P <= T else 'dual'
+        if blur is None:
+            blur = sparse.identity(P, dtype=pred.dtype, format='csr')
+        self.pred = pred
+        self.blur = blur
+        self.form = form
+        self.lambd = lambd
+        self.mean = np.mean(pred, axis=0)
+
+        if form == 'primal':
+            # blur @ (centered data' @ centered data) @ blur.T
+            if gram is None:
+                gram = np.matmul(pred.T, pred)
+                gram -= T * np.outer(self.mean, self.mean)
+            gram = blur.dot(blur.dot(gram).T).T
+        elif form == 'dual':
+            # centered data @ (blur.T @ blur) @ centered data'
+            blur2 = (blur.T.dot(blur)).tocsr()
+            gram = np.empty((T, T), dtype=pred.dtype)
+            for i in range(0, T, blockSize):
+                gram[i:i + blockSize] = np.matmul(blur2.dot(pred[i:i + blockSize].T).T, pred.T)
+            u = np.matmul(pred, blur2.dot(self.mean))
+            gram -= u[:, np.newaxis]
+            gram -= u[np.newaxis, :]
+            gram += np.dot(self.mean, blur2.dot(self.mean))
+        else:
+            raise ValueError('Unknown form {0} of ridge regression'.format(form))
+
+        if factorization == 'cholesky':
+            gram[np.diag_indices_from(gram)] += lambd
+            self.factor = cho_factor(gram, lower=True, overwrite_a=True, check_finite=False)
+        elif factorization == 'eigh':
+            self.factor = None
+            self.eigvals, self.eigvecs = eigh(gram, overwrite_a=True, check_finite=False, driver='evd')
+        else:
+            raise ValueError('Unknown factorization {0} of ridge regression'.format(factorization))
+
+    def _solveNormal(self, b, lambd=None):
+        """ Solve the regularized normal equations for right-hand side b
+        """
+        if self.factor is not None:
+            return cho_solve(self.factor, b, check_finite=False)
+        lambd = self.lambd if lambd is None else lambd
+        return np.matmul(self.eigvecs, np.matmul(self.eigvecs.T, b) / (self.eigvals + lambd))
+
+    def solve(self, y, lambd=None):
+        """ Solve the regression for target y
+
+        Args:
+            y: 1-D array or sparse matrix
+                target of the regression, one value per frame, or a sparse frames x 1 column
+                as built by spikeTemplateVector
 
+            lambd: float or None
+                regularization parameter, self.lambd if None; only the eigh factorization
+                can solve for another one
 
+        Returns:
+            weights: 1-D array
+                intercept followed by one coefficient per pixel of the blurred predictor
+        """
+        if sparse.issparse(y):
+            y_mean = y.sum() / y.shape[0]
+            if self.form == 'primal':
+                # only the frames where the target is nonzero enter X'y; X'yc = X'y - T * y_mean * mean
+                Xty = np.asarray(y.T.dot(self.pred)).ravel() - y.shape[0] * y_mean * self.mean
+                w = self._solveNormal(self.blur.dot(Xty.astype(self.pred.dtype)), lambd)
+                intercept = y_mean - np.dot(self.blur.dot(self.mean), w)
+                return np.concatenate([[intercept], w]).astype(self.pred.dtype)
+            y = y.toarray().ravel()
+        y_mean = np.mean(y)
+        yc = (y - y_mean).astype(self.pred.dtype)
+        if self.form == 'primal':
+            # the target is centered, so X'yc equals Xc'yc
+            w = self._solveNormal(self.blur.dot(np.matmul(self.pred.T, yc)), lambd)
+        else:
+            alpha = self._solveNormal(yc, lambd)
+            w = self.blur.dot(np.matmul(self.pred.T, alpha) - self.mean * np.sum(alpha))
+        intercept = y_mean - np.dot(self.blur.dot(self.mean), w)
+        return np.concatenate([[intercept], w]).astype(self.pred.dtype)
 
 
+def crossValidateRidge(pred, y, lambdas, blurs, nFolds=5, gram=None):
+    """
+    Function for K-fold cross validation of the ridge regression of RidgeSolver over spatial
+    blurs and regularization parameters. Folds are contiguous blocks of frames. Every training
+    set is eigendecomposed once per blur, in the primal or the dual form like RidgeSolver, and
+    all lambdas are solved from the same eigendecomposition, i.e. nFolds * len(blurs)
+    eigendecompositions. In the primal form, the Gram matrix of every training set is the one
+    of all frames minus the one of the held-out fold, with a rank-one correction for the mean
+    of the training frames, so every training set is solved exactly with its own centering.
 
+    Args:
+        pred: 2-D array
+            data of the predictor, frames x pixels
 
+        y: 1-D array or sparse matrix
+            target of the regression, one value per frame
+
+        lambdas: 1-D array
+            regularization parameters to evaluate
+
+        blurs: list of sparse matrices
+            spatial blurs to evaluate, pixels x pixels
+
+        nFolds: int
+            number of folds
+
+        gram: 2-D array or None
+            centered pred' @ pred computed beforehand; implies the primal form
+
+    Returns:
+        errors: 2-D array
+            held-out squared error summed over folds, blurs x lambdas
+    """
+    if sparse.issparse(y):
+        y = y.toarray().ravel()
+    T, P = pred.shape
+    bounds = np.linspace(0, T, nFolds + 1).astype(int)
+    mean = np.mean(pred, axis=0)
+    if gram is None and P <= T - np.max(np.diff(bounds)):
+        gram = np.matmul(pred.T, pred)
+        gram -= T * np.outer(mean, mean)
+
+    errors = np.zeros((len(blurs), len(lambdas)))
+    for k in range(nFolds):
+        fold = slice(bounds[k], bounds[k + 1])
+        inFold = np.zeros(T, dtype=bool)
+        inFold[fold] = True
+        nTrain = T - np.sum(inFold)
+
+        trainGram = None
+        if gram is not None:
+            # centered with the mean of all frames, the training frames have mean shift
+            foldPred = pred[fold] - mean
+            shift = -np.sum(foldPred, axis=0) / nTrain
+            trainGram = gram - np.matmul(foldPred.T, foldPred)
+            trainGram -= nTrain * np.outer(shift, shift)
+            del foldPred
+
+        trainPred = pred[~inFold]
+        for s, blur in enumerate(blurs):
+            solver = RidgeSolver(trainPred, lambdas[0], blur=blur, factorization='eigh', gram=trainGram)
+            for l, lambd in enumerate(lambdas):
+                w = solver.solve(y[~inFold], lambd)
+                errors[s, l] += np.sum((y[fold] - w[0] - np.matmul(pred[fold], blur.T.dot(w[1:]))) ** 2)
+            del solver
+    return errors
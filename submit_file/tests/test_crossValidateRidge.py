@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Cross validation of the ridge regression against refitting every training set from scratch.
+"""
+import numpy as np
+from scipy import sparse
+
+from caiman.source_extraction.volpy.spikePursuit import RidgeSolver, crossValidateRidge, gaussianBlurMatrix
+
+shape = (12, 12)
+sigmas = [1, 1.5, 2]
+
+
+def regression(T=2000, seed=0):
+    """ Predictor with a large mean and a few shared components, and a spiking target
+    """
+    rng = np.random.default_rng(seed)
+    P = shape[0] * shape[1]
+    y = np.zeros(T)
+    y[rng.choice(T, T // 50, replace=False)] = 1
+    y = np.convolve(y, [1, .6, .3], 'same')
+    pred = rng.standard_normal((T, 10)) @ rng.standard_normal((10, P)) + rng.standard_normal((T, P)) + 5
+    pred += np.outer(y, rng.random(P))
+    return pred, y
+
+
+def refitErrors(pred, y, lambdas, blurs, nFolds=5):
+    """ Held-out errors of a RidgeSolver fitted on each training set
+    """
+    T = pred.shape[0]
+    bounds = np.linspace(0, T, nFolds + 1).astype(int)
+    errors = np.zeros((len(blurs), len(lambdas)))
+    for k in range(nFolds):
+        inFold = np.zeros(T, dtype=bool)
+        inFold[bounds[k]:bounds[k + 1]] = True
+        for s, blur in enumerate(blurs):
+            for l, lambd in enumerate(lambdas):
+                w = RidgeSolver(pred[~inFold], lambd, blur=blur, form='primal').solve(y[~inFold])
+                errors[s, l] += np.sum((y[inFold] - w[0] - pred[inFold] @ blur.T.dot(w[1:])) ** 2)
+    return errors
+
+
+def test_crossValidateRidge_matches_refit():
+    pred, y = regression()
+    blurs = [gaussianBlurMatrix(shape, sig).astype(np.double) for sig in sigmas]
+    lambdas = np.sum(pred ** 2) * np.logspace(-6, -3, 3)
+    errors = crossValidateRidge(pred, y, lambdas, blurs)
+    assert errors.shape == (len(sigmas), len(lambdas))
+    np.testing.assert_allclose(errors, refitErrors(pred, y, lambdas, blurs), rtol=1e-8)
+
+
+def test_crossValidateRidge_sparse_target_and_gram():
+    pred, y = regression(seed=1)
+    blurs = [gaussianBlurMatrix(shape, sig).astype(np.double) for sig in sigmas]
+    lambdas = np.sum(pred ** 2) * np.logspace(-6, -3, 3)
+    mean = np.mean(pred, axis=0)
+    gram = pred.T @ pred - len(pred) * np.outer(mean, mean)
+    errors = crossValidateRidge(pred, sparse.csr_matrix(y[:, np.newaxis]), lambdas, blurs, gram=gram)
+    np.testing.assert_allclose(errors, crossValidateRidge(pred, y, lambdas, blurs), rtol=1e-10)
+
+
+def test_crossValidateRidge_dual_form():
+    # more pixels than training frames, the regression is decomposed in the dual form
+    pred, y = regression(T=100, seed=2)
+    blurs = [gaussianBlurMatrix(shape, sig).astype(np.double) for sig in sigmas]
+    lambdas = np.sum(pred ** 2) * np.logspace(-6, -3, 3)
+    errors = crossValidateRidge(pred, y, lambdas, blurs)
+    np.testing.assert_allclose(errors, refitErrors(pred, y, lambdas, blurs), rtol=1e-8)
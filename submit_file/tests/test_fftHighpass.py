@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parity of the FFT high-pass backend with the filtfilt high-pass it replaces, away from
+the ends of the recording where the two handle the edges differently.
+"""
+import numpy as np
+import pytest
+from scipy import signal
+
+from caiman.source_extraction.volpy.spikePursuit import fftHighpass, highpassVideo
+
+sampleRate = 400
+
+
+def traces(nSignals=4, T=20000, seed=0):
+    """ Slow random walks plus white noise, like voltage imaging traces
+    """
+    rng = np.random.default_rng(seed)
+    return 0.05 * np.cumsum(rng.standard_normal((nSignals, T)), axis=1) + rng.standard_normal((nSignals, T))
+
+
+def filtfiltHighpass(data, freq, order):
+    """ The high-pass of volspike before the FFT backend
+    """
+    b, a = signal.butter(order, freq / (sampleRate / 2), 'high')
+    return signal.filtfilt(b, a, data, padtype='odd', padlen=3 * (max(len(b), len(a)) - 1))
+
+
+def interior(data, freq):
+    """ data without 3 periods of the cutoff at each end
+    """
+    edge = int(3 * sampleRate / freq)
+    return data[..., edge:-edge]
+
+
+@pytest.mark.parametrize('freq, order', [(1, 1), (1 / 3, 3)])
+def test_fftHighpass_matches_filtfilt(freq, order):
+    # the 1 Hz filter of denoiseSpikes and the tau_lp high-pass of the context window
+    data = traces()
+    reference = filtfiltHighpass(data, freq, order)
+    filtered = fftHighpass(data, freq / (sampleRate / 2), order=order)
+    assert filtered.shape == data.shape
+    error = np.max(np.abs(interior(filtered - reference, freq)))
+    assert error < 1e-3 * np.std(reference)
+
+
+def test_fftHighpass_single_trace():
+    data = traces(nSignals=1)
+    filtered = fftHighpass(data[0], 1 / (sampleRate / 2), order=1)
+    reference = filtfiltHighpass(data[0], 1, 1)
+    assert np.max(np.abs(interior(filtered - reference, 1))) < 1e-3 * np.std(reference)
+
+
+@pytest.mark.parametrize('backend', ['iir', 'fft'])
+def test_highpassVideo_matches_filtfilt(backend):
+    # pixels x frames, in blocks smaller than the number of pixels
+    freq = 1 / 3
+    data = traces(nSignals=300, T=12000)
+    reference = filtfiltHighpass(data, freq, 3)
+    filtered = highpassVideo(data, freq, sampleRate, blockSize=64, backend=backend)
+    assert filtered.dtype == np.single
+    error = np.max(np.abs(interior(filtered - reference, freq)))
+    assert error < 1e-3 * np.std(reference)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Parity of the whitened matched filter with its original implementation, which zero-padded
+every Welch segment to the length of the transform of the whole signal.
+"""
+import numpy as np
+import pytest
+from scipy import signal
+
+from caiman.source_extraction.volpy.spikePursuit import whitenedMatchedFilter, whitenedMatchedFilterBatch
+
+sampleRate = 400
+window = np.arange(-8, 9)
+
+
+def spikingTrace(T, seed):
+    """ 1 Hz high-passed trace with slow fluctuations, white noise and about 80 spikes, and
+        the spike times
+    """
+    rng = np.random.default_rng(seed)
+    data = 0.05 * np.cumsum(rng.standard_normal(T)) + rng.standard_normal(T)
+    locs = np.sort(rng.choice(np.arange(20, T - 20), 80, replace=False))
+    data[locs] += 6
+    data[locs + 1] += 3
+    bb, aa = signal.butter(1, 1 / (sampleRate / 2), 'high')
+    data = signal.filtfilt(bb, aa, data, padtype='odd', padlen=3 * (max(len(bb), len(aa)) - 1))
+    return data, locs
+
+
+def originalFilter(data, locs, window):
+    """ whitenedMatchedFilter before the PSD was computed on short segments
+    """
+    N = int(np.ceil(np.log2(len(data))))
+    censor = np.zeros(len(data))
+    censor[locs] = 1
+    censor = np.int16(np.convolve(censor.flatten(), np.ones([1, len(window)]).flatten(), 'same'))
+    censor = (censor < 0.5)
+    noise = data[censor]
+
+    _, pxx = signal.welch(noise, fs=2 * np.pi, window=signal.get_window('hamming', 1000), nfft=2 ** N,
+                          detrend=False, nperseg=1000)
+    Nf2 = np.concatenate([pxx, np.flipud(pxx[1:-1])])
+    scaling = 1 / np.sqrt(Nf2)
+    dataScaled = np.real(np.fft.ifft(np.fft.fft(data, 2 ** N) * scaling))
+    PTDscaled = dataScaled[(locs[:, np.newaxis] + window)]
+    PTAscaled = np.mean(PTDscaled, 0)
+    datafilt = np.convolve(dataScaled, np.flipud(PTAscaled), 'same')
+    return datafilt[:len(data)]
+
+
+@pytest.mark.parametrize('T, seed', [(3000, 0), (3000, 1), (10000, 2), (20000, 3), (36000, 4)])
+def test_whitenedMatchedFilter_matches_original(T, seed):
+    data, locs = spikingTrace(T, seed)
+    reference = originalFilter(data, locs, window)
+    filtered = whitenedMatchedFilter(data, locs, window)
+    assert np.max(np.abs(filtered - reference)) < 1e-8 * np.max(np.abs(reference))
+
+
+def test_whitenedMatchedFilterBatch_matches_original():
+    T = 10000
+    traces = [spikingTrace(T, seed) for seed in range(5)]
+    data = np.array([d for d, _ in traces])
+    isLoc = np.zeros(data.shape, dtype=bool)
+    for n, (_, locs) in enumerate(traces):
+        isLoc[n, locs] = True
+    filtered = whitenedMatchedFilterBatch(data, isLoc, window)
+    for n, (d, locs) in enumerate(traces):
+        reference = originalFilter(d, locs, window)
+        assert np.max(np.abs(filtered[n] - reference)) < 1e-8 * np.max(np.abs(reference))
@@ -12,7 +12,15 @@ import os
 import psutil
 import scipy
 import sys
-from .spikePursuit import volspike
+import time
+import caiman as cm
+from .fftPlans import saveWisdom
+from .estimates import EstimatesStore, VolpyEstimates, checkpointKey, movieFolder, movieKey
+from .globalModels import computeGlobalBackground, computeGlobalSignal
+from .sharedArrays import toSharedMemory
+from .movieIO import extractCrops
+from .processPool import VolpyPool
+from .spikePursuit import contextWindow, volspikeGroup
 from .Volparams import volparams
 
 try:
@@ -33,19 +41,23 @@ class VOLPY(object):
     """
     def __init__(self, n_processes, dview=None, doCrossVal=False, doGlobalSubtract=False,
             contextSize=50, censorSize=12, nPC_bg=8, tau_lp=3, tau_pred=1, sigmas=np.array([1,1.5,2]),
-            nIter=5, localAlign=False, globalAlign=True, highPassRegression=False, params=None):
+            nIter=5, localAlign=False, globalAlign=True, highPassRegression=False, nIterWarm=2,
+            globalBackground=False, sharedCrops=False, groupOverlap=0, memoryBudget=None, hpBackend='iir', hpThreads=1, fftWisdom=None,
+            jaccardTol=0, weightTol=0, diagnostics=False, resultsFolder=None, outputFields=None, params=None):
         """
             n_processes: int
                 number of processed used (if in parallel this controls memory usage)
 
             dview: Direct View object
-                for parallelization pruposes when using ipyparallel
+                for parallelization pruposes when using ipyparallel, a multiprocessing pool, or a
+                processPool.VolpyPool to run on a single machine without a caiman cluster
 
             doCrossVal: boolean
                 whether to use cross validation to optimize regression regularization parameters
 
             doGlobalSubtract: boolean
-                whether to subtract the signal which can be predicted by the entire video
+                whether to subtract the signal which can be predicted by the entire video; the global signal
+                is estimated once per recording and shared with the workers in shared memory
 
             contextSize: int
                 number of pixels surrounding the ROI to use as context
@@ -69,27 +81,95 @@ class VOLPY(object):
             nIter: int
                 number of iterations alternating between estimating temporal and spatial filters
 
+            nIterWarm: int
+                number of iterations for cells starting from the spatial weights of a previous block
+
+            jaccardTol: float
+                iterations stop early once the Jaccard distance between the spike sets of consecutive iterations is
+                at most jaccardTol and the relative change of the spatial weights at most weightTol; with both 0
+                they stop only when further iterations would repeat the last one. None never stops early. nIterRun
+                gives the iterations run; num_spikes is padded with the last count to max(nIter, nIterWarm) + 1 per cell
+
+            weightTol: float
+                tolerance on the relative change of the spatial weights, see jaccardTol
+
+            diagnostics: boolean
+                whether to store the arrays of the diagnostic figures of every cell in self.estimates['diagnostics'];
+                nothing is plotted while fitting, report.renderReport draws them afterwards
+
+            resultsFolder: str
+                folder of an estimates.EstimatesStore; if given, the output of every cell is written to it as soon as
+                the cell finishes instead of being kept in memory, and cells which fail are recorded in
+                self.estimates['failed'] instead of stopping the fit. Cells already in the folder and computed from
+                the same movie, ROI, initial weights and parameters are not run again, so an interrupted fit resumes
+                where it stopped. Every movie is stored in its own subfolder named after the memory map file, so the
+                data blocks of a recording can share the folder
+
+            outputFields: list of str
+                outputs of volspike kept in self.estimates, e.g. ['spikeTimes', 'yFilt', 'dFF']; if None, the default
+                fields of fit. The other outputs are dropped by the workers instead of being sent back, and with
+                resultsFolder the workers write the outputs to the folder and send back nothing else
+
             localAlign: boolean
 
             globalAlign: boolean
 
             highPassRegression: boolean
                 whether to regress on a high-passed version of the data. Slightly improves detection of spikes,
-                but makes subthreshold unreliable"""
+                but makes subthreshold unreliable
+
+            globalBackground: boolean
+                whether to compute the background principal components once for the whole movie with all ROIs
+                masked out, instead of once per cell
+
+            sharedCrops: boolean
+                whether to extract the context windows of all cells in a single pass over the movie into shared
+                memory, instead of reading the memory map file once per cell; needs memory for all the windows
+
+            groupOverlap: float
+                cells whose context windows overlap by at least this fraction (intersection over union with the
+                window of the group) are processed together, loading, filtering and decomposing the union of their
+                windows once; 0 processes every cell on its own
+
+            memoryBudget: int
+                bytes of memory that the cells running at the same time may use; the peak memory of every cell is
+                estimated from its context window and the number of frames, and cells are admitted to the workers
+                only while the total stays under the budget. By default 80% of the memory available when fit starts
+
+            hpBackend: str, 'iir' or 'fft'
+                backend of the zero-phase high-pass filters; 'iir' filters forward and backward, 'fft' applies the
+                same magnitude response in the frequency domain, which is faster for long recordings and agrees
+                with 'iir' except within about 1/cutoff seconds of the ends of the recording
+
+            hpThreads: int
+                number of threads of the high-pass filters in every worker; the default of 1 leaves the cores to
+                the workers, raise it only when there are fewer workers than cores
+
+            fftWisdom: str
+                file of FFTW wisdom; the FFTs of the length of the recording are planned once in fit, saved to it,
+                and loaded by every worker instead of being measured again in each process"""
 
         self.dview = dview
         if params is None:
             self.params =volparams(doCrossVal=doCrossVal, doGlobalSubtract=doGlobalSubtract,
             contextSize=contextSize, censorSize=censorSize, nPC_bg=nPC_bg, tau_lp=tau_lp, tau_pred=tau_pred, sigmas=sigmas,
-            nIter=nIter, localAlign=localAlign, globalAlign=globalAlign, highPassRegression=highPassRegression)
+            nIter=nIter, nIterWarm=nIterWarm, localAlign=localAlign, globalAlign=globalAlign, highPassRegression=highPassRegression,
+            globalBackground=globalBackground, sharedCrops=sharedCrops, groupOverlap=groupOverlap,
+            memoryBudget=memoryBudget, hpBackend=hpBackend, hpThreads=hpThreads, fftWisdom=fftWisdom,
+            jaccardTol=jaccardTol, weightTol=weightTol, diagnostics=diagnostics,
+            resultsFolder=resultsFolder, outputFields=outputFields)
         else:
             self.params = params
             #params.set('patch', {'n_processes': n_processes})
-        self.estimates = {}
+        self.estimates = VolpyEstimates()
 
-    def fit(self):
+    def fit(self, progress=None):
         """Run the volspike function to detect spikes and save the result 
         into self.estimate        
+
+        Args:
+            progress: function
+                called as progress(done, total, cellNs) every time a work unit finishes, cellNs being its cells
         """
         args = dict()
         args['doCrossVal'] = self.params.volspike['doCrossVal']
@@ -101,43 +181,315 @@ class VOLPY(object):
         args['tau_pred'] = self.params.volspike['tau_pred']
         args['sigmas'] = self.params.volspike['sigmas']
         args['nIter'] = self.params.volspike['nIter']
+        args['nIterWarm'] = self.params.volspike['nIterWarm']
+        args['jaccardTol'] = self.params.volspike['jaccardTol']
+        args['weightTol'] = self.params.volspike['weightTol']
+        args['diagnostics'] = self.params.volspike['diagnostics']
+        args['resultsFolder'] = self.params.data['resultsFolder']
+        args['outputFields'] = self.params.volspike['outputFields']
+        if args['outputFields'] is None:
+            args['outputFields'] = ['spikeTimes', 'yFilt', 'spatialFilter', 'cellN', 'templates', 'snr', 'num_spikes',
+                                    'nIterRun', 'passedLocalityTest', 'low_spk', 'weights']
+        args['outputFields'] = list(args['outputFields'])
+        if 'cellN' not in args['outputFields']:
+            args['outputFields'].insert(0, 'cellN')
+        if args['diagnostics'] and 'diagnostics' not in args['outputFields']:
+            args['outputFields'].append('diagnostics')
         args['localAlign'] = self.params.volspike['localAlign']
         args['globalAlign'] = self.params.volspike['globalAlign']
         args['highPassRegression'] = self.params.volspike['highPassRegression']
+        args['globalBackground'] = self.params.volspike['globalBackground']
+        args['sharedCrops'] = self.params.volspike['sharedCrops']
+        args['groupOverlap'] = self.params.volspike['groupOverlap']
+        args['memoryBudget'] = self.params.volspike['memoryBudget']
+        args['hpBackend'] = self.params.volspike['hpBackend']
+        args['hpThreads'] = self.params.volspike['hpThreads']
+        args['fftWisdom'] = self.params.volspike['fftWisdom']
 
         args_in = []
         fnames = self.params.data['fnames']
         fr = self.params.data['fr']
-        for i in self.params.data['index']:
-            ROIs = self.params.data['ROIs'][i]
-            if  self.params.data['weights'] == None:
-                weights = None
+        args['fnames_tiled'] = self.params.data['fnames_tiled']
+        args['fnames_hp'] = self.params.data['fnames_hp']
+
+        index = self.params.data['index']
+        ROIs = self.params.data['ROIs']
+        weights_init = self.params.data['weights']
+        order = {i: k for k, i in enumerate(index)}
+        initial = {}
+        for i in index:
+            if weights_init is None:
+                initial[i] = None
+            elif len(weights_init) == len(index):
+                # filters of a previous block, e.g. vpy.estimates['spatialFilter'], follow the order of index
+                initial[i] = weights_init[order[i]]
             else:
-                weights = self.params.data['weights'][i]
-            args_in.append([fnames, fr, i, ROIs, weights, args])
-
-        if 'multiprocessing' in str(type(self.dview)):
-            results = self.dview.map_async(volspike, args_in).get(4294967)
-        elif self.dview is not None:
-            results = self.dview.map_sync(volspike,args_in)
+                initial[i] = weights_init[i]
+
+        # with a store, the cells already computed from the same movie, ROI and parameters are not run again
+        store = None if args['resultsFolder'] is None else EstimatesStore(movieFolder(args['resultsFolder'], fnames))
+        todo = index
+        if store is not None:
+            params = {k: v for k, v in args.items()
+                      if k not in ['resultsFolder', 'memoryBudget', 'hpThreads', 'fftWisdom', 'sharedCrops', 'fnames_tiled']}
+            params['fr'] = fr
+            params['fnames_hp'] = args['fnames_hp'] is not None
+            movie = movieKey(fnames)
+            # the workers write every cell to the store with its key
+            args['keys'] = {i: checkpointKey(movie, i, ROIs[i], initial[i], params) for i in index}
+            todo = [i for i in index if not store.isCurrent(i, args['keys'][i])]
+            if len(todo) < len(index):
+                logging.info('Resuming: {0} of {1} cells already in {2}'.format(len(index) - len(todo), len(index),
+                                                                              store.folder))
+
+        # background components shared by all cells
+        if args['globalBackground'] and todo:
+            logging.info('Computing global background components')
+            args['bgModel'] = computeGlobalBackground(fnames, fr, self.params.data['ROIs'], args['censorSize'],
+                                                      args['tau_lp'], 5 * args['nPC_bg'])
+        else:
+            args['bgModel'] = None
+
+        # global signal estimated once and broadcast to the workers through shared memory
+        shared = []
+        if args['doGlobalSubtract'] and todo:
+            logging.info('Computing global signal')
+            globalSignal = computeGlobalSignal(fnames, fr, self.params.data['ROIs'], args['censorSize'],
+                                               args['tau_lp'], args['nPC_bg'])
+            shm, args['globalSignal'] = toSharedMemory(globalSignal)
+            shared.append(shm)
+        else:
+            args['globalSignal'] = None
+
+        # cells with overlapping context windows share one work unit
+        windows = {i: contextWindow(ROIs[i], args['contextSize']) for i in todo}
+        groups = groupCells(windows, args['groupOverlap'])
+        if len(groups) < len(todo):
+            logging.info('Processing {0} cells in {1} groups'.format(len(todo), len(groups)))
+
+        # context windows of all groups extracted in a single pass over the movie, keyed by their first cell
+        if args['sharedCrops']:
+            logging.info('Extracting the context windows of all cells')
+            unions = {group[0]: unionWindow([windows[i] for i in group]) for group in groups}
+            if args['fnames_hp'] is not None:
+                source = args['fnames_hp']
+            elif args['fnames_tiled'] is not None:
+                source = args['fnames_tiled']
+            else:
+                source = fnames
+            shms, args['crops'] = extractCrops(source, unions, ROIs.shape[1:])
+            shared.extend(shms)
         else:
-            results = list(map(volspike, args_in))
-
-        N = len(results)
-        self.estimates['spikeTimes'] = [results[i]['spikeTimes'] for i in range(N)]
-        self.estimates['trace'] = [results[i]['yFilt'] for i in range(N)]
-        self.estimates['spatialFilter'] = [results[i]['spatialFilter'] for i in range(N)]
-        self.estimates['cellN'] = [results[i]['cellN'] for i in range(N)]
-        self.estimates['templates'] = [results[i]['templates'] for i in range(N)]
-        self.estimates['snr'] = [results[i]['snr'] for i in range(N)]
-        self.estimates['num_spikes'] = [results[i]['num_spikes'] for i in range(N)]
-        self.estimates['passedLocalityTest'] = [results[i]['passedLocalityTest'] for i in range(N)]
-        self.estimates['low_spk'] = [results[i]['low_spk'] for i in range(N)]
-        self.estimates['weights'] = [results[i]['weights'] for i in range(N)]
+            args['crops'] = None
+
+        Yr, _, T = cm.load_memmap(fnames)
+        footprints = []
+        for group in groups:
+            cells = [[i, ROIs[i], initial[i]] for i in group]
+            args_in.append([fnames, fr, cells, args])
+            footprints.append(estimateMemory(unionWindow([windows[i] for i in group]), len(group), T, Yr.dtype, args))
+        del Yr
+
+        # FFT plans of the matched filter measured once and shared with the workers
+        if args['fftWisdom'] is not None:
+            saveWisdom(args['fftWisdom'], [2 ** int(np.ceil(np.log2(T)))])
+
+        # largest work units first, admitted while their estimated memory fits in the budget
+        budget = args['memoryBudget']
+        if budget is None:
+            budget = 0.8 * psutil.virtual_memory().available
+        schedule = np.argsort(footprints)[::-1]
+        args_in = [args_in[k] for k in schedule]
+        footprints = [footprints[k] for k in schedule]
+        if footprints and footprints[0] > budget:
+            logging.warning('The largest cell needs about {0:.1f} GB, more than the memory budget of {1:.1f} GB'.format(
+                footprints[0] / 2 ** 30, budget / 2 ** 30))
+
+        # results are consumed as the work units finish, either kept in memory or written to the store
+        results = []
+        done = []
+
+        def onResult(k, outputs):
+            if store is None:
+                results.extend(outputs)
+            else:
+                for output in outputs:
+                    store.clearFailure(output['cellN'])
+            done.append(k)
+            if progress is not None:
+                progress(len(done), len(args_in), [output['cellN'] for output in outputs])
+
+        def onError(k, error):
+            # with a store, a failed work unit is recorded and the others go on
+            cells = [cell[0] for cell in args_in[k][2]]
+            logging.error('Cells {0} failed: {1}'.format(cells, error))
+            store.addFailure(cells, error)
+            done.append(k)
+            if progress is not None:
+                progress(len(done), len(args_in), [])
+
+        try:
+            if isinstance(self.dview, VolpyPool) or 'multiprocessing' in str(type(self.dview)):
+                runScheduled(lambda pars: self.dview.apply_async(volspikeGroup, (pars,)),
+                             args_in, footprints, budget, onResult, None if store is None else onError)
+            elif self.dview is not None:
+                lview = self.dview.client.load_balanced_view()
+                runScheduled(lambda pars: lview.apply_async(volspikeGroup, pars),
+                             args_in, footprints, budget, onResult, None if store is None else onError)
+            else:
+                for k, pars in enumerate(args_in):
+                    try:
+                        outputs = volspikeGroup(pars)
+                    except Exception as error:
+                        if store is None:
+                            raise
+                        onError(k, error)
+                        continue
+                    onResult(k, outputs)
+        finally:
+            for shm in shared:
+                shm.close()
+                shm.unlink()
+
+        fields = args['outputFields']
+        if store is None:
+            results = sorted(results, key=lambda r: order[r['cellN']])
+            self.estimates = VolpyEstimates({('trace' if field == 'yFilt' else field): [r[field] for r in results]
+                                             for field in fields})
+        else:
+            self.estimates = VolpyEstimates.fromStore(store, index, fields, rename={'yFilt': 'trace'})
+            self.estimates['failed'] = sorted(cellN for cellN in store.failures if cellN in order)
 
         return self
 
 
+def estimateMemory(window, nCells, T, dtype, args):
+    """ Estimate the peak memory of volspikeGroup for a work unit
+
+    Args:
+        window: tuple
+            (Xinds, Yinds) union of the context windows of the work unit
+
+        nCells: int
+            number of cells of the work unit
+
+        T: int
+            number of frames
+
+        dtype: dtype
+            type of the movie
+
+        args: dictionary
+            parameters of volspike
+
+    Returns:
+        nbytes: int
+            estimated peak memory in bytes
+    """
+    P = len(window[0]) * len(window[1])
+    # the crop, its float32 high-passed, low-passed and predictor copies, the float64
+    # buffers of the temporal filter and the windows of the cells sliced from the union
+    nbytes = P * T * (np.dtype(dtype).itemsize + 4 * (3 + args['highPassRegression']) + 16)
+    if nCells > 1:
+        nbytes += P * T * 4 * (2 + args['highPassRegression']) + 4 * min(P, T) ** 2
+    # normal equations of the ridge regression and their factorization
+    nbytes += 2 * 4 * min(P, T) ** 2
+    return int(nbytes)
+
+
+def runScheduled(submit, tasks, footprints, budget, onResult, onError=None, poll=0.05):
+    """ Run tasks on a pool of workers, submitting them in order while the sum of the
+        footprints of the running tasks stays under the budget. A task is always
+        submitted when nothing runs, so a task larger than the budget runs alone.
+        Results are handed over as soon as the tasks finish, in any order.
+
+    Args:
+        submit: function
+            submits a task and returns an asynchronous result with ready() and get()
+
+        tasks: list
+            arguments of every task
+
+        footprints: list
+            estimated memory of every task in bytes
+
+        budget: float
+            memory of the tasks running at the same time in bytes
+
+        onResult: function
+            called as onResult(k, result) when task k finishes
+
+        onError: function
+            called as onError(k, error) when task k fails; if None the error is raised
+
+        poll: float
+            seconds between checks of the running tasks
+    """
+    running = {}
+    used = 0
+    k = 0
+    while k < len(tasks) or running:
+        while k < len(tasks) and (not running or used + footprints[k] <= budget):
+            running[k] = submit(tasks[k])
+            used += footprints[k]
+            k += 1
+        done = [j for j, res in running.items() if res.ready()]
+        for j in done:
+            used -= footprints[j]
+            try:
+                result = running.pop(j).get()
+            except Exception as error:
+                if onError is None:
+                    raise
+                onError(j, error)
+                continue
+            onResult(j, result)
+            del result
+        if not done:
+            time.sleep(poll)
+
+
+def unionWindow(windows):
+    """ Smallest window containing all the given (Xinds, Yinds) windows
+    """
+    Xinds = np.arange(min(X[0] for X, Y in windows), max(X[-1] for X, Y in windows) + 1)
+    Yinds = np.arange(min(Y[0] for X, Y in windows), max(Y[-1] for X, Y in windows) + 1)
+    return Xinds, Yinds
+
+
+def groupCells(windows, groupOverlap):
+    """ Greedily group cells whose context windows overlap. A cell joins the first group
+        whose window overlaps its own by at least groupOverlap (intersection over union),
+        which bounds the growth of the union window of every group.
+
+    Args:
+        windows: dict
+            (Xinds, Yinds) context window of each cell, keyed by cell number
+
+        groupOverlap: float
+            minimum intersection over union for joining a group, 0 disables grouping
+
+    Returns:
+        groups: list
+            lists of cell numbers, in the order of windows
+    """
+    groups = []
+    for i, (X, Y) in windows.items():
+        box = (X[0], X[-1] + 1, Y[0], Y[-1] + 1)
+        for group in groups:
+            gbox = group[1]
+            inter = max(0, min(box[1], gbox[1]) - max(box[0], gbox[0])) * \
+                    max(0, min(box[3], gbox[3]) - max(box[2], gbox[2]))
+            union = (box[1] - box[0]) * (box[3] - box[2]) + (gbox[1] - gbox[0]) * (gbox[3] - gbox[2]) - inter
+            if groupOverlap > 0 and inter >= groupOverlap * union:
+                group[0].append(i)
+                group[1] = (min(box[0], gbox[0]), max(box[1], gbox[1]), min(box[2], gbox[2]), max(box[3], gbox[3]))
+                break
+        else:
+            groups.append([[i], box])
+    return [group[0] for group in groups]
+
+
 
 
 